@@ -21,6 +21,8 @@
 当有一天我们的程序需要去适配 maxos 的时候，我们直接去创建一个新类: MacOSDriveFactory 即可，无需更改其他现有代码
 """
 
+import importlib
+import threading
 from abc import ABC, abstractmethod
 
 
@@ -107,28 +109,86 @@ class LinuxDriveFactory(AbstractDriveFactory):
         return LinuxKeyboardDrive()
 
 
+# 驱动家族注册表: 名称 -> "module:Class"
+# 只有第一次用到某个家族时才会导入它所在的模块，程序启动时不必为所有操作系统的驱动付出导入成本
+class DriveFactoryRegistry:
+
+    def __init__(self) -> None:
+        self._paths = {}
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, path: str) -> None:
+        assert ":" in path, "path must look like 'module:Class'"
+        with self._lock:
+            self._paths[name] = path
+            self._classes.pop(name, None)
+
+    def get(self, name: str) -> type:
+        try:
+            return self._classes[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._classes:
+                try:
+                    module_name, class_name = self._paths[name].split(":", 1)
+                except KeyError:
+                    raise LookupError(f"drive family `{name}` is not registered") from None
+                module = importlib.import_module(module_name)
+                self._classes[name] = getattr(module, class_name)
+            return self._classes[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._paths
+
+
+drive_factory_registry = DriveFactoryRegistry()
+# NOTE: 示例中的两个家族都定义在本模块里，注册它们并不会省下任何导入成本，这里只演示注册/查找的用法。
+# 真正按需导入需要把每个家族放进独立模块，再注册为 "drives.linux:LinuxDriveFactory" 这样的路径
+drive_factory_registry.register("window", f"{__name__}:WindowDriveFactory")
+drive_factory_registry.register("linux", f"{__name__}:LinuxDriveFactory")
+
+
 class DriveApplicationInterface():
     
-    def __init__(self):
+    def __init__(self, registry: DriveFactoryRegistry = drive_factory_registry):
         self._drive = None
+        self._registry = registry
+        # 驱动对象没有状态，同一个工厂下每种驱动只需要创建一次
+        self._products = {}
 
     def load_drive(self, drive_class=None):
         assert drive_class, "os drive not found"
+        if isinstance(drive_class, str):
+            drive_class = self._registry.get(drive_class)
         self._drive = drive_class()
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """丢弃已缓存的驱动对象，下次访问时由当前工厂重新创建"""
+        self._products.clear()
 
     @property
     def drive(self):
         if self._drive is None:
             self.load_drive()
         return self._drive
+
+    def _product(self, kind: str, create):
+        try:
+            return self._products[kind]
+        except KeyError:
+            product = self._products[kind] = create()
+            return product
     
     @property
     def mouse_drive(self):
-        return self.drive.create_mouse_drive()
+        return self._product("mouse", self.drive.create_mouse_drive)
     
     @property
     def keyboard_drive(self):
-        return self.drive.create_keyboard_drive()
+        return self._product("keyboard", self.drive.create_keyboard_drive)
 
 
 if __name__ == "__main__":
@@ -155,5 +215,10 @@ if __name__ == "__main__":
     app.keyboard_drive.press()
     """
 
+    # 也可以通过注册表中的名称加载驱动家族，切换家族时缓存的驱动对象会失效
+    app.load_drive("window")
+    app.mouse_drive.click()
+    print(app.mouse_drive is app.mouse_drive)
+
 
 
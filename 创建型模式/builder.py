@@ -11,32 +11,50 @@
 
 
 class Food:
-    """食品类"""
+    """
+    食品类
+    食品对象没有任何实例状态，名称与价格都是类属性，因此每种食品只需要一个共享的享元实例，
+    Cola() 每次返回的都是同一个对象; __slots__ = () 让实例没有 __dict__，也就无法被修改
+    """
+    __slots__ = ()
+    _flyweights = {}
+
+    def __new__(cls):
+        try:
+            return Food._flyweights[cls]
+        except KeyError:
+            instance = Food._flyweights[cls] = super().__new__(cls)
+            return instance
 
     @property
     def food_name(self):
         return self.__name__
 
 class Cola(Food):
+    __slots__ = ()
     __name__ = "可乐"
     price = 6
 
 class Milk(Food):
+    __slots__ = ()
     __name__ = "牛奶"
     price = 12
 
 
 class Chips(Food):
+    __slots__ = ()
     __name__ = "薯条"
     price = 18
 
 
 class Chicken(Food):
+    __slots__ = ()
     __name__ = "鸡米花"
     price = 20
 
 
 class Hamburg(Food):
+    __slots__ = ()
     __name__ = "汉堡"
     price = 35
 
@@ -56,6 +74,7 @@ class Hamburg(Food):
 # 比如一个完整的套餐需要包含饮料、主食、小吃三个部分，我们的第一版代码是没有实现的
 
 from abc import ABC, abstractmethod
+from operator import attrgetter
 from typing import Any
 
 # 抽象套餐生成器
@@ -105,20 +124,30 @@ class ConcreteBuilderPackage(PackageBuilder):
 
 # 套餐
 class Package:
+    __slots__ = ("staple", "drink", "snacks", "total")
+
+    # 类别 -> 对应的列表，用查表代替 if/elif
+    _categories = {
+        "staple": attrgetter("staple"),
+        "drink": attrgetter("drink"),
+        "snacks": attrgetter("snacks"),
+    }
 
     def __init__(self):
         self.staple = []
         self.drink = []
         self.snacks = []
+        # 边添加边累计总价，查询价格是 O(1)
+        self.total = 0
 
     def add(self, food_type: str, food: Any) -> None:
+        category = self._categories.get(food_type)
+        if category is not None:
+            category(self).append(food)
+            self.total += food.price
 
-        if food_type == "staple":
-            self.staple.append(food)
-        elif food_type == "drink":
-            self.drink.append(food)
-        elif food_type == "snacks":
-            self.snacks.append(food)
+    def freeze(self) -> 'FrozenPackage':
+        return FrozenPackage(self.staple, self.drink, self.snacks)
 
     def show(self):
         print("您的套餐包含: ")
@@ -128,7 +157,89 @@ class Package:
         print(f"\t饮料类: {drink}")
         snacks = ",".join([food.food_name for food in self.snacks])
         print(f"\t小吃类: {snacks}")
-        print(f"\t总价为: {sum([food.price for food in (self.snacks + self.drink + self.staple)])} 元")
+        print(f"\t总价为: {self.total} 元")
+
+
+# 不可变套餐: 可以被多个订单共享，也可以作为字典的键
+class FrozenPackage(Package):
+    __slots__ = ("_hash",)
+
+    def __init__(self, staple=(), drink=(), snacks=()):
+        setattr_ = object.__setattr__
+        setattr_(self, "staple", tuple(staple))
+        setattr_(self, "drink", tuple(drink))
+        setattr_(self, "snacks", tuple(snacks))
+        setattr_(self, "total", sum(food.price for food in (*self.staple, *self.drink, *self.snacks)))
+        setattr_(self, "_hash", hash((self.staple, self.drink, self.snacks)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenPackage is immutable")
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenPackage):
+            return NotImplemented
+        return (self.staple, self.drink, self.snacks) == (other.staple, other.drink, other.snacks)
+
+    def add(self, food_type: str, food: Any) -> None:
+        raise TypeError("FrozenPackage is immutable, use derive() or thaw()")
+
+    def freeze(self) -> 'FrozenPackage':
+        return self
+
+    def derive(self, staple=(), drink=(), snacks=()) -> 'FrozenPackage':
+        """在当前套餐基础上追加食品，得到一个新的不可变套餐"""
+        return FrozenPackage(self.staple + tuple(staple), self.drink + tuple(drink), self.snacks + tuple(snacks))
+
+    def thaw(self) -> Package:
+        """得到一个可以继续修改的普通套餐"""
+        package = Package()
+        package.staple.extend(self.staple)
+        package.drink.extend(self.drink)
+        package.snacks.extend(self.snacks)
+        package.total = self.total
+        return package
+
+
+# 套餐配方缓存: 大部分订单都是几十种标准套餐之一，每种组合只通过建造者构建一次
+class RecipeCache:
+
+    def __init__(self, builder: PackageBuilder = None) -> None:
+        self._builder = builder or ConcreteBuilderPackage()
+        self._recipes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, staple=(), drink=(), snacks=()) -> FrozenPackage:
+        """参数为 Food 子类的序列，返回共享的不可变套餐"""
+        key = (tuple(staple), tuple(drink), tuple(snacks))
+        try:
+            package = self._recipes[key]
+        except KeyError:
+            self.misses += 1
+            package = self._recipes[key] = self._build(*key)
+            return package
+        self.hits += 1
+        return package
+
+    def _build(self, staple, drink, snacks) -> FrozenPackage:
+        for food in staple:
+            self._builder.add_staple(food)
+        for food in drink:
+            self._builder.add_drink(food)
+        for food in snacks:
+            self._builder.add_snacks(food)
+        return self._builder.package.freeze()
+
+    def __len__(self) -> int:
+        return len(self._recipes)
+
+    def metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "recipes": len(self),
+                "hit_rate": self.hits / total if total else 0.0}
 
 
 class Application:
@@ -146,3 +257,190 @@ class Application:
 
 Application().run()
 
+
+# ---------------------------------------------------------------------------------------------
+# 点餐系统v3.0, 批量计价
+# 每一批要给上百万个订单计价，逐个构建 Package 再求和太慢，而且每个 Food 都是一个新对象。
+# 列式存储: 每个类别用两个数组保存所有订单的食品 id(类似 CSR 稀疏矩阵)，
+#     offsets[i]:offsets[i + 1] 是第 i 个订单在 food_ids 中的区间
+# 计价时用食品 id 直接索引价格表，有 NumPy 时整批向量化计算
+
+import random
+import time
+import tracemalloc
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+CATEGORIES = ("staple", "drink", "snacks")
+FOOD_TYPES = (Cola, Milk, Chips, Chicken, Hamburg)
+FOOD_IDS = {food: food_id for food_id, food in enumerate(FOOD_TYPES)}
+PRICE_TABLE = array("q", [food.price for food in FOOD_TYPES])
+
+
+class OrderBatch:
+
+    def __init__(self) -> None:
+        self._offsets = {category: array("q", [0]) for category in CATEGORIES}
+        self._food_ids = {category: array("h") for category in CATEGORIES}
+
+    def __len__(self) -> int:
+        return len(self._offsets["staple"]) - 1
+
+    def add_order(self, staple=(), drink=(), snacks=()) -> None:
+        """每个参数是该类别下的 Food 子类列表"""
+        for category, foods in zip(CATEGORIES, (staple, drink, snacks)):
+            food_ids = self._food_ids[category]
+            food_ids.extend(FOOD_IDS[food] for food in foods)
+            self._offsets[category].append(len(food_ids))
+
+    def columns(self, category: str):
+        return self._offsets[category], self._food_ids[category]
+
+
+def price_batch(batch: OrderBatch):
+    """计算一批订单的总价，返回与订单顺序一致的数组"""
+    if np is None:
+        return _price_batch_python(batch)
+    prices = np.frombuffer(PRICE_TABLE, dtype=np.int64)
+    totals = np.zeros(len(batch), dtype=np.int64)
+    for category in CATEGORIES:
+        offsets, food_ids = batch.columns(category)
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        # 前缀和之差即为每个订单在该类别下的金额，空订单也能正确处理
+        cumulative = np.concatenate(([0], np.cumsum(prices[np.frombuffer(food_ids, dtype=np.int16)])))
+        totals += cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+    return totals
+
+
+def _price_batch_python(batch: OrderBatch):
+    totals = array("q", bytes(8 * len(batch)))
+    for category in CATEGORIES:
+        offsets, food_ids = batch.columns(category)
+        prices = [PRICE_TABLE[food_id] for food_id in food_ids]
+        for i in range(len(batch)):
+            totals[i] += sum(prices[offsets[i]:offsets[i + 1]])
+    return totals
+
+
+def benchmark(orders=200000):
+    menu = {"staple": (Hamburg, Chicken), "drink": (Cola, Milk), "snacks": (Chips, Chicken)}
+    raw_orders = [
+        {category: [random.choice(foods) for _ in range(random.randint(0, 2))] for category, foods in menu.items()}
+        for _ in range(orders)
+    ]
+
+    start = time.perf_counter()
+    builder = ConcreteBuilderPackage()
+    expected = []
+    for order in raw_orders:
+        for food in order["staple"]:
+            builder.add_staple(food)
+        for food in order["drink"]:
+            builder.add_drink(food)
+        for food in order["snacks"]:
+            builder.add_snacks(food)
+        package = builder.package
+        expected.append(sum(food.price for food in (package.snacks + package.drink + package.staple)))
+    package_cost = time.perf_counter() - start
+
+    # 两边都从原始订单开始计时: 列式一侧包括填充 OrderBatch 与计价两步
+    start = time.perf_counter()
+    batch = OrderBatch()
+    for order in raw_orders:
+        batch.add_order(**order)
+    fill_cost = time.perf_counter() - start
+    totals = price_batch(batch)
+    batch_cost = time.perf_counter() - start
+
+    assert list(totals) == expected
+    print(f"逐个构建 Package 并计价: {package_cost:.3f}s")
+    print(f"列式批量计价({'numpy' if np is not None else 'python'}): {batch_cost:.3f}s"
+          f"(其中填充 OrderBatch {fill_cost:.3f}s, 计价 {batch_cost - fill_cost:.3f}s)")
+
+
+def benchmark_memory(packages=1000000):
+    """构建 100 万个套餐: 原始实现(每次新建 Food、无 __slots__) 与 享元 + __slots__ 的内存对比"""
+
+    class LegacyFood:
+        pass
+
+    legacy_foods = {food: type(f"Legacy{food.__qualname__}", (LegacyFood,), {"price": food.price}) for food in FOOD_TYPES}
+
+    class LegacyPackage:
+
+        def __init__(self):
+            self.staple = []
+            self.drink = []
+            self.snacks = []
+
+        def add(self, food_type, food):
+            if food_type == "staple":
+                self.staple.append(food)
+            elif food_type == "drink":
+                self.drink.append(food)
+            elif food_type == "snacks":
+                self.snacks.append(food)
+
+    def build(package_class, make_food):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = []
+        for _ in range(packages):
+            package = package_class()
+            package.add("staple", make_food(Hamburg))
+            package.add("drink", make_food(Cola))
+            package.add("snacks", make_food(Chips))
+            result.append(package)
+        cost = time.perf_counter() - start
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return cost, current
+
+    for name, package_class, make_food in (
+        ("原始实现", LegacyPackage, lambda food: legacy_foods[food]()),
+        ("享元实现", Package, lambda food: food()),
+    ):
+        cost, memory = build(package_class, make_food)
+        print(f"{name}: {cost:.2f}s, {memory / 1024 / 1024:.0f} MiB")
+
+
+def benchmark_recipes(orders=500000, combos=40):
+    """标准套餐订单: 每次用建造者重新构建 与 配方缓存 的吞吐量对比"""
+    menu = {"staple": (Hamburg, Chicken), "drink": (Cola, Milk), "snacks": (Chips, Chicken)}
+    standard = [
+        tuple(tuple(random.choice(foods) for _ in range(random.randint(0, 2))) for foods in menu.values())
+        for _ in range(combos)
+    ]
+    sample = [random.choice(standard) for _ in range(orders)]
+
+    builder = ConcreteBuilderPackage()
+    start = time.perf_counter()
+    for staple, drink, snacks in sample:
+        for food in staple:
+            builder.add_staple(food)
+        for food in drink:
+            builder.add_drink(food)
+        for food in snacks:
+            builder.add_snacks(food)
+        builder.package
+    rebuild_cost = time.perf_counter() - start
+
+    cache = RecipeCache()
+    start = time.perf_counter()
+    for staple, drink, snacks in sample:
+        cache.get(staple, drink, snacks)
+    cached_cost = time.perf_counter() - start
+
+    print(f"逐个构建: {orders / rebuild_cost:.0f} 单/s, 配方缓存: {orders / cached_cost:.0f} 单/s")
+    print(cache.metrics())
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark_recipes()
+    benchmark_memory()
+
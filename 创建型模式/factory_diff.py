@@ -4,7 +4,11 @@
 # ----------------
 # 几种工厂模式的比较
 # ----------------
+import multiprocessing
+import random
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
 
 # 业务场景：A公司是一家做给不同的电脑厂商外设做驱动检测的公司，那么就需要一个执行驱动检测的程序，早期的时候，公司业务不大，规模很小，所以就只做鼠标驱动
@@ -208,3 +212,264 @@ class Application:
         self.load_driver_factory(HPDriverFactory).execute_check()
         self.load_driver_factory(DellDriverFactory).execute_check()
 
+
+
+# [5]-------------------------------------------注册表工厂---------------------------------------------------
+# 简单工厂的 if/elif 链随着品牌的增加越来越长，查找成本也随之线性增长
+# 注册表工厂: 驱动类在定义时通过 __init_subclass__ 自动登记到注册表中，分发只是一次字典查找，
+# 新增品牌只需要新增一个子类，既满足开闭原则，查找成本也与品牌数量无关
+
+class RegistryMouseDriver:
+    """可自动注册的鼠标驱动基类，子类通过 brand 参数声明自己的品牌"""
+
+    _registry = {}
+
+    def __init_subclass__(cls, brand=None, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if brand is not None:
+            assert brand not in RegistryMouseDriver._registry, f"brand `{brand}` already registered"
+            RegistryMouseDriver._registry[brand] = cls
+            cls.brand = brand
+
+    def click(self):
+        print("鼠标执行了单击操作")
+
+
+class RegistryDriverFactory:
+
+    @staticmethod
+    def get_drive(option):
+        try:
+            return RegistryMouseDriver._registry[option]()
+        except KeyError:
+            return None
+
+    @staticmethod
+    def unregister(option):
+        RegistryMouseDriver._registry.pop(option, None)
+
+
+class RegistryHPMouseDriver(RegistryMouseDriver, brand="hp"):
+
+    def click(self):
+        print("HP品牌鼠标执行了单击操作")
+
+
+class RegistryDellMouseDriver(RegistryMouseDriver, brand="dell"):
+
+    def click(self):
+        print("Dell品牌鼠标执行了单击操作")
+
+
+class Application:
+
+    def run_check(self):
+        RegistryDriverFactory.get_drive("dell").click()
+        RegistryDriverFactory.get_drive("hp").click()
+
+
+# [6]-------------------------------------------性能对比---------------------------------------------------
+# 在 2 ~ 10000 个品牌下，比较各种方式获取一个驱动对象的平均耗时
+
+def benchmark(brand_counts=(2, 10, 100, 1000, 10000), lookups=20000):
+    print(f"{'brands':>7} {'无工厂':>8} {'简单工厂':>8} {'工厂方法':>8} {'抽象工厂':>8} {'注册表':>8}  (us/次)")
+    for count in brand_counts:
+        brands = [f"brand{i}" for i in range(count)]
+        drivers = {brand: type(f"{brand}MouseDriver", (RegistryMouseDriver,), {}, brand=brand) for brand in brands}
+
+        # 简单工厂: 生成包含 count 个分支的判断链
+        # 每个分支都直接 return，与 if/elif 的查找成本相同，但避免了上万层嵌套的 elif 让解析器耗尽内存
+        lines = ["def get_drive(option):"]
+        for brand in brands:
+            lines.append(f"    if option == {brand!r}:")
+            lines.append(f"        return drivers[{brand!r}]()")
+        lines.append("    return None")
+        namespace = {"drivers": drivers}
+        exec("\n".join(lines), namespace)
+        simple_get_drive = namespace["get_drive"]
+
+        # 工厂方法: 每个品牌一个工厂子类
+        method_factories = {
+            brand: type(f"{brand}DriverFactory", (), {"get_dirve_instance": lambda self, d=driver: d()})
+            for brand, driver in drivers.items()
+        }
+        # 抽象工厂: 每个品牌一个工厂子类，生产一组相关的驱动
+        abstract_factories = {
+            brand: type(f"{brand}AbstractDriverFactory", (), {
+                "get_window_dirve_instance": lambda self, d=driver: d(),
+                "get_linux_dirve_instance": lambda self, d=driver: d(),
+            })
+            for brand, driver in drivers.items()
+        }
+
+        sample = [random.choice(brands) for _ in range(lookups)]
+        variants = (
+            lambda brand: drivers[brand](),
+            simple_get_drive,
+            lambda brand: method_factories[brand]().get_dirve_instance(),
+            lambda brand: abstract_factories[brand]().get_window_dirve_instance(),
+            RegistryDriverFactory.get_drive,
+        )
+        costs = []
+        for get_drive in variants:
+            start = time.perf_counter()
+            for brand in sample:
+                get_drive(brand)
+            costs.append((time.perf_counter() - start) / lookups * 1e6)
+        print(f"{count:>7} " + " ".join(f"{cost:>10.3f}" for cost in costs))
+
+        for brand in brands:
+            RegistryDriverFactory.unregister(brand)
+
+
+# [7]-------------------------------------------并发检测---------------------------------------------------
+# 生产环境中需要对上百个品牌工厂依次调用 execute_check()，总耗时是所有检测耗时之和
+# DriverCheckRunner 把检测放到线程池或进程池中并发执行，总耗时接近最慢的那一个检测
+
+class CheckResult:
+
+    def __init__(self, name, status, elapsed, error=None):
+        self.name = name
+        self.status = status        # ok / failed / timeout
+        self.elapsed = elapsed
+        self.error = error
+
+    def __repr__(self):
+        return f"CheckResult({self.name!r}, {self.status!r}, {self.elapsed:.4f}s)"
+
+
+class CheckReport:
+
+    def __init__(self, results, wall_time):
+        self.results = results
+        self.wall_time = wall_time
+
+    @staticmethod
+    def _percentile(values, p):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    @property
+    def failures(self):
+        return [result for result in self.results if result.status != "ok"]
+
+    def summary(self) -> dict:
+        elapsed = [result.elapsed for result in self.results if result.status == "ok"]
+        return {
+            "total": len(self.results),
+            "ok": len(elapsed),
+            "failed": sum(result.status == "failed" for result in self.results),
+            "timeout": sum(result.status == "timeout" for result in self.results),
+            "p50": self._percentile(elapsed, 0.5),
+            "p99": self._percentile(elapsed, 0.99),
+            "slowest": max(elapsed, default=0.0),
+            "wall_time": self.wall_time,
+        }
+
+
+def _timed_check(index, factory, starts):
+    # 记录开始时间，父进程据此判断单个检测是否超时(排队等待的时间不计入)
+    starts[index] = time.time()
+    start = time.perf_counter()
+    try:
+        factory.execute_check()
+    except Exception as error:
+        return time.perf_counter() - start, f"{type(error).__name__}: {error}"
+    return time.perf_counter() - start, None
+
+
+class DriverCheckRunner:
+    """
+        mode: thread / process，检测是 IO 密集时用线程，CPU 密集时用进程
+        max_workers: 并发数
+        timeout: 单个检测的超时秒数，超时的检测不会被强制终止，但不再等待它的结果
+    """
+
+    def __init__(self, mode="thread", max_workers=None, timeout=None):
+        assert mode in ("thread", "process"), "mode must be thread or process"
+        self.mode = mode
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def run(self, factories) -> CheckReport:
+        factories = list(factories)
+        names = [type(factory).__name__ for factory in factories]
+        results = [None] * len(factories)
+        manager = None
+        if self.mode == "process":
+            manager = multiprocessing.Manager()
+            starts = manager.dict()
+            executor = ProcessPoolExecutor(self.max_workers)
+        else:
+            starts = {}
+            executor = ThreadPoolExecutor(self.max_workers)
+
+        wall_start = time.perf_counter()
+        try:
+            futures = {executor.submit(_timed_check, i, factory, starts): i for i, factory in enumerate(factories)}
+            pending = set(futures)
+            poll = None if self.timeout is None else min(0.05, self.timeout / 10)
+            while pending:
+                done, pending = wait(pending, timeout=poll, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = futures[future]
+                    try:
+                        elapsed, error = future.result()
+                    except Exception as error_:
+                        # 进程崩溃、参数无法序列化等
+                        elapsed, error = 0.0, f"{type(error_).__name__}: {error_}"
+                    results[i] = CheckResult(names[i], "failed" if error else "ok", elapsed, error)
+                if self.timeout is None:
+                    continue
+                now = time.time()
+                for future in list(pending):
+                    i = futures[future]
+                    started = starts.get(i)
+                    if started is not None and now - started > self.timeout:
+                        pending.discard(future)
+                        future.cancel()
+                        results[i] = CheckResult(names[i], "timeout", now - started, "timeout")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if manager is not None:
+                manager.shutdown()
+        return CheckReport(results, time.perf_counter() - wall_start)
+
+
+class SimulatedCheckFactory:
+    """模拟一个耗时 delay 秒的驱动检测"""
+
+    def __init__(self, delay, fail=False):
+        self.delay = delay
+        self.fail = fail
+
+    def execute_check(self):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("驱动检测失败")
+
+
+def benchmark_runner(checks=200, max_workers=200):
+    factories = [SimulatedCheckFactory(random.uniform(0.01, 0.1), fail=(i % 50 == 0)) for i in range(checks)]
+    factories.append(SimulatedCheckFactory(2.0))
+
+    start = time.perf_counter()
+    for factory in factories[:20]:
+        try:
+            factory.execute_check()
+        except RuntimeError:
+            pass
+    print(f"串行执行前 20 个检测: {time.perf_counter() - start:.2f}s")
+
+    report = DriverCheckRunner("thread", max_workers=max_workers, timeout=1.0).run(factories)
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    Application().run_check()
+    benchmark()
+
+    print(DriverCheckRunner("process", max_workers=2).run([HPDriverFactory(), DellDriverFactory()]).summary())
+    benchmark_runner()
@@ -6,13 +6,30 @@
 # -----------#
 
 
+import asyncio
+import bisect
+import hashlib
+import itertools
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 
 
 class DatabaseWapper:
     """
     定义一个数据库操作类
     """
+    _pool = None
+    _statement_cache = None
+    _result_cache = None
+
     @abstractmethod
     def create_connection(self) -> 'Connection':
         """
@@ -21,11 +38,78 @@ class DatabaseWapper:
         raise NotImplementedError('`create_connection()` must be implemented.')
     
 
-    def execute_sql(self, sql):
-        conn = self.create_connection()
-        conn.check(sql)
-        return conn.execute(sql)
-    
+    def use_pool(self, **options) -> 'ConnectionPool':
+        """开启连接池模式，之后 execute_sql 从池中借用连接而不是每次都重新连接"""
+        self._pool = ConnectionPool(self.create_connection, **options)
+        return self._pool
+
+    def use_statement_cache(self, maxsize: int = 1024) -> 'StatementCache':
+        """开启语句缓存，同一条 SQL 只需检查一次"""
+        self._statement_cache = StatementCache(maxsize)
+        return self._statement_cache
+
+    def use_result_cache(self, cache: 'ResultCache' = None) -> 'ResultCache':
+        """开启查询结果缓存，经过本 Wapper 的写操作会使相关表的缓存失效"""
+        self._result_cache = cache if cache is not None else LRUResultCache()
+        return self._result_cache
+
+    @contextmanager
+    def _connection(self):
+        if self._pool is not None:
+            with self._pool.connection() as conn:
+                yield conn
+        else:
+            conn = self.create_connection()
+            try:
+                yield conn
+            finally:
+                conn.close()
+
+    def _check(self, conn: 'Connection', sql) -> None:
+        if self._statement_cache is None:
+            conn.check(sql)
+        else:
+            self._statement_cache.check(conn, sql)
+
+    def _execute(self, sql, params=()):
+        with self._connection() as conn:
+            self._check(conn, sql)
+            return conn.execute(sql, params)
+
+    def execute_sql(self, sql, params=(), ttl: float = None):
+        """ttl: 本条查询结果的缓存秒数，不传则使用缓存的默认值"""
+        cache = self._result_cache
+        if cache is None:
+            return self._execute(sql, params)
+        if not _SELECT.match(sql):
+            # 写操作使相关表的缓存失效；无法识别写了哪些表的语句，保守地清空全部缓存
+            written = written_tables(sql)
+            try:
+                return self._execute(sql, params)
+            finally:
+                if written:
+                    cache.invalidate_tables(written)
+                else:
+                    cache.clear()
+        tables = read_tables(sql)
+        if not tables:
+            # 无法可靠判断依赖哪些表的语句不缓存，避免读到永远不会失效的结果
+            return self._execute(sql, params)
+        return cache.get_or_load(result_cache_key(sql, params), tables, lambda: self._execute(sql, params), ttl)
+
+    def execute_many(self, sql, param_rows):
+        """同一条 SQL 只检查一次，所有参数通过同一个连接批量执行"""
+        try:
+            with self._connection() as conn:
+                self._check(conn, sql)
+                return conn.execute_many(sql, param_rows)
+        finally:
+            if self._result_cache is not None:
+                written = written_tables(sql)
+                if written:
+                    self._result_cache.invalidate_tables(written)
+                else:
+                    self._result_cache.clear()
 
 
 class MySQLDatabaseWapper(DatabaseWapper):
@@ -40,6 +124,23 @@ class OracleDatabaseWapper(DatabaseWapper):
         return OracleConnection()
 
 
+def _require_database_file(database: str) -> str:
+    # 每个连接单独打开数据库，":memory:" 会让每个连接(包括连接池中的每个连接)各自拿到一个空数据库
+    if not database or database == ":memory:":
+        raise ValueError("sqlite stand-in requires a database file path, not an in-memory database")
+    return database
+
+
+class SQLiteDatabaseWapper(DatabaseWapper):
+    """本地替身: 用 sqlite 模拟真实数据库，用于测试与性能基准；database 是数据库文件路径"""
+
+    def __init__(self, database: str) -> None:
+        self.database = _require_database_file(database)
+
+    def create_connection(self) -> 'Connection':
+        return SQLiteConnection(self.database)
+
+
 class Connection(ABC):
 
     @abstractmethod
@@ -47,7 +148,18 @@ class Connection(ABC):
         pass
 
     @abstractmethod
-    def execute(self, sql) -> None:
+    def execute(self, sql, params=()) -> None:
+        pass
+
+    def execute_many(self, sql, param_rows) -> None:
+        for params in param_rows:
+            self.execute(sql, params)
+
+    def ping(self) -> bool:
+        """健康检查，连接池借出连接前调用"""
+        return True
+
+    def close(self) -> None:
         pass
 
 class MySQLConnection(Connection):
@@ -55,7 +167,7 @@ class MySQLConnection(Connection):
     def check(self, sql) -> None:
         print("mysql语句检查通过")
 
-    def execute(self, sql) -> None:
+    def execute(self, sql, params=()) -> None:
         print("mysql语句执行成功")
 
 
@@ -64,14 +176,838 @@ class OracleConnection(Connection):
     def check(self, sql) -> None:
         print("oracle语句检查通过")
 
-    def execute(self, sql) -> None:
+    def execute(self, sql, params=()) -> None:
         print("oracle语句执行成功")
 
 
+class SQLiteConnection(Connection):
+
+    def __init__(self, database: str) -> None:
+        # 连接会在连接池中被不同的线程借用，但同一时刻只有一个线程持有
+        self._conn = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+
+    def check(self, sql) -> None:
+        if not sqlite3.complete_statement(sql):
+            raise ValueError(f"invalid sql: {sql!r}")
+
+    def execute(self, sql, params=()) -> list:
+        return self._conn.execute(sql, params).fetchall()
+
+    def execute_many(self, sql, param_rows) -> int:
+        # executemany 会逐个消费迭代器，参数不需要一次性全部放进内存
+        self._conn.execute("begin")
+        try:
+            rowcount = self._conn.executemany(sql, param_rows).rowcount
+        except BaseException:
+            self._conn.execute("rollback")
+            raise
+        self._conn.execute("commit")
+        return rowcount
+
+    def ping(self) -> bool:
+        try:
+            self._conn.execute("select 1")
+        except sqlite3.Error:
+            return False
+        return True
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+# ---------------------------------------------------------------------------------------------
+# 语句缓存: 同一条 SQL 文本可能被执行上百万次，每次都 check 是浪费
+# 以规范化后的 SQL 作为键缓存检查结果，LRU 淘汰
+
+class StatementCache:
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        assert maxsize > 0, "maxsize must be positive"
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(sql: str) -> str:
+        return " ".join(sql.split())
+
+    def check(self, conn: Connection, sql: str) -> None:
+        key = self.normalize(sql)
+        with self._lock:
+            if key in self._statements:
+                self._statements.move_to_end(key)
+                self.hits += 1
+                return
+            self.misses += 1
+        # 检查失败会抛出异常，不会进入缓存
+        conn.check(sql)
+        with self._lock:
+            self._statements[key] = True
+            if len(self._statements) > self.maxsize:
+                self._statements.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._statements)
+
+    def metrics(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self),
+                "hit_rate": self.hits / total if total else 0.0}
+
+
+# ---------------------------------------------------------------------------------------------
+# 结果缓存: QueryApp.query 每次访问都会重新执行 select * from users;
+# 结果按 (SQL, 参数) 缓存，支持每条查询单独的 TTL、LRU 容量上限，
+# 经过同一个 Wapper 的写操作会使其涉及的表上的所有缓存失效；
+# 缓存未命中时同一个键只允许一个线程去执行查询，其他线程等待它的结果，防止缓存击穿(stampede)
+
+_SELECT = re.compile(r"^\s*select\b", re.IGNORECASE)
+# 捕获 from / join 之后的表名，第二个分组用于发现 schema.table 这种带点的写法
+_READ_TABLES = re.compile(r"\b(?:from|join)\s+[`\"\[]?(\w+)([`\"\]]?\s*\.)?", re.IGNORECASE)
+# FROM 子句: from 到下一个子句关键字之间的部分
+_FROM_CLAUSE = re.compile(
+    r"\bfrom\b(.*?)(?=\b(?:where|group|order|limit|having|union|join|on)\b|;|$)",
+    re.IGNORECASE | re.DOTALL,
+)
+_WRITE_TABLES = re.compile(
+    r"^\s*(?:insert\s+(?:or\s+\w+\s+)?into|replace\s+into|update|delete\s+from|"
+    r"truncate(?:\s+table)?|drop\s+table(?:\s+if\s+exists)?|alter\s+table|create\s+table(?:\s+if\s+not\s+exists)?)"
+    r"\s+(?:[`\"\[]?\w+[`\"\]]?\s*\.\s*)?[`\"\[]?(\w+)",
+    re.IGNORECASE,
+)
+
+
+def read_tables(sql: str) -> frozenset:
+    """
+    返回查询依赖的表；无法可靠解析时返回空集合，调用方将不缓存该查询:
+    子查询或函数调用(括号)、FROM 子句中用逗号列出的多张表、schema.table 形式的表名
+    """
+    if "(" in sql:
+        return frozenset()
+    if any("," in clause for clause in _FROM_CLAUSE.findall(sql)):
+        return frozenset()
+    tables = set()
+    for name, dotted in _READ_TABLES.findall(sql):
+        if dotted:
+            return frozenset()
+        tables.add(name.lower())
+    return frozenset(tables)
+
+
+def written_tables(sql: str) -> frozenset:
+    """schema.table 只取表名部分"""
+    return frozenset(name.lower() for name in _WRITE_TABLES.findall(sql))
+
+
+def _hashable_params(params):
+    if isinstance(params, dict):
+        return tuple(sorted(params.items()))
+    return tuple(params)
+
+
+def result_cache_key(sql: str, params=()):
+    # 使用原始 SQL 文本: 规范化空白会改变字符串字面量的含义，例如 'a  b' 与 'a b'
+    return sql, _hashable_params(params)
+
+
+class ResultCache(ABC):
+    """可插拔的结果缓存接口"""
+
+    @abstractmethod
+    def get_or_load(self, key, tables: frozenset, loader, ttl: float = None):
+        raise NotImplementedError('`get_or_load()` must be implemented.')
+
+    @abstractmethod
+    def invalidate_tables(self, tables) -> None:
+        raise NotImplementedError('`invalidate_tables()` must be implemented.')
+
+    @abstractmethod
+    def clear(self) -> None:
+        raise NotImplementedError('`clear()` must be implemented.')
+
+
+class _InFlight:
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LRUResultCache(ResultCache):
+
+    def __init__(self, maxsize: int = 1024, default_ttl: float = 60.0) -> None:
+        assert maxsize > 0, "maxsize must be positive"
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()   # key -> (expires_at, tables, result)
+        self._tables = {}               # table -> 依赖它的 key 集合
+        self._generations = {}          # table -> 写入次数，用于丢弃查询期间被写过的结果
+        self._epoch = 0                 # clear() 次数，作用同上
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "misses": 0, "coalesced": 0, "evictions": 0, "invalidations": 0}
+
+    def _remove(self, key) -> None:
+        _, tables, _ = self._entries.pop(key)
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    def get_or_load(self, key, tables: frozenset, loader, ttl: float = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._metrics["hits"] += 1
+                    return entry[2]
+                self._remove(key)
+            self._metrics["misses"] += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _InFlight()
+                generations = {table: self._generations.get(table, 0) for table in tables}
+                epoch = self._epoch
+            else:
+                self._metrics["coalesced"] += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = loader()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                stale = epoch != self._epoch or any(self._generations.get(table, 0) != generation
+                                                    for table, generation in generations.items())
+                if flight.error is None and not stale and ttl > 0:
+                    self._entries[key] = (time.monotonic() + ttl, tables, flight.result)
+                    for table in tables:
+                        self._tables.setdefault(table, set()).add(key)
+                    while len(self._entries) > self.maxsize:
+                        self._remove(next(iter(self._entries)))
+                        self._metrics["evictions"] += 1
+            flight.event.set()
+        return flight.result
+
+    def invalidate_tables(self, tables) -> None:
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                for key in list(self._tables.get(table, ())):
+                    self._remove(key)
+                    self._metrics["invalidations"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._tables.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return dict(self._metrics, size=len(self._entries))
+
+
+# ---------------------------------------------------------------------------------------------
+# 连接池: execute_sql 每次都调用 create_connection()，每条查询都要付出完整的建连成本
+# ConnectionPool 只依赖一个"创建连接"的工厂方法，因此对 MySQL、Oracle、sqlite 的 Wapper 都适用
+
+class PoolTimeout(TimeoutError):
+    """等待可用连接超时"""
+
+
+class PoolClosed(RuntimeError):
+    """连接池已经关闭"""
+
+
+class ConnectionPool:
+    """
+    连接池
+        min_size: 空闲回收时至少保留的连接数
+        max_size: 最多同时存在的连接数
+        idle_timeout: 空闲超过该秒数的连接会被关闭(保留 min_size 个)
+        timeout: 连接全部被借出时，最多等待的秒数
+    """
+
+    def __init__(self, connection_factory, min_size: int = 1, max_size: int = 10,
+                 idle_timeout: float = 300.0, timeout: float = 30.0) -> None:
+        assert 0 <= min_size <= max_size and max_size > 0, "require 0 <= min_size <= max_size"
+        self._factory = connection_factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._metrics = {"checkouts": 0, "hits": 0, "misses": 0, "waits": 0,
+                         "wait_time": 0.0, "timeouts": 0, "evicted": 0, "unhealthy": 0}
+        for _ in range(min_size):
+            self._idle.append((self._factory(), time.monotonic()))
+            self._size += 1
+
+    def _evict_idle(self) -> list:
+        # 最早归还的连接在队首，超过空闲时间的依次移出；由调用者在锁外关闭
+        now = time.monotonic()
+        evicted = []
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.idle_timeout:
+            conn, _ = self._idle.popleft()
+            self._size -= 1
+            self._metrics["evicted"] += 1
+            evicted.append(conn)
+        return evicted
+
+    def _checkout(self, deadline: float, timeout: float):
+        """在锁内取出一个空闲连接，或者占用一个新建连接的名额(返回 None)"""
+        waited = False
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolClosed("pool is closed")
+                evicted = self._evict_idle()
+                if self._idle:
+                    # 后进先出: 刚归还的连接最"热"，也让队首的连接有机会被空闲回收
+                    conn, _ = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._metrics["timeouts"] += 1
+                    raise PoolTimeout(f"no connection available within {timeout}s")
+                waited = True
+                self._cond.wait(remaining)
+            if waited:
+                self._metrics["waits"] += 1
+                self._metrics["wait_time"] += time.monotonic() - start
+        return conn, evicted
+
+    def acquire(self, timeout: float = None) -> Connection:
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            conn, evicted = self._checkout(deadline, timeout)
+            # 关闭连接、健康检查、建连都可能涉及网络往返，不要在持有锁的时候进行
+            for stale in evicted:
+                stale.close()
+            if conn is None:
+                try:
+                    conn = self._factory()
+                except BaseException:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._metrics["misses"] += 1
+                    self._metrics["checkouts"] += 1
+                return conn
+            if conn.ping():
+                with self._cond:
+                    self._metrics["hits"] += 1
+                    self._metrics["checkouts"] += 1
+                return conn
+            with self._cond:
+                self._size -= 1
+                self._metrics["unhealthy"] += 1
+                self._cond.notify()
+            conn.close()
+
+    def release(self, conn: Connection) -> None:
+        with self._cond:
+            closed = self._closed
+            if closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+        if closed:
+            conn.close()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def metrics(self) -> dict:
+        with self._cond:
+            metrics = dict(self._metrics, size=self._size, idle=len(self._idle))
+        checkouts = metrics["checkouts"]
+        metrics["hit_rate"] = metrics["hits"] / checkouts if checkouts else 0.0
+        metrics["avg_wait"] = metrics["wait_time"] / metrics["waits"] if metrics["waits"] else 0.0
+        return metrics
+
+
+def benchmark(queries=2000, threads=8):
+    """比较 每次建连 与 连接池 的查询耗时(sqlite 本地替身)"""
+    with tempfile.TemporaryDirectory() as workdir:
+        database = SQLiteDatabaseWapper(os.path.join(workdir, "bench.db"))
+        database.execute_sql("create table users (id integer primary key, name text);")
+        database.execute_sql("insert into users (name) values ('mnio');")
+
+        def run():
+            def worker():
+                for _ in range(queries // threads):
+                    database.execute_sql("select * from users;")
+            workers = [threading.Thread(target=worker) for _ in range(threads)]
+            start = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            return time.perf_counter() - start
+
+        direct = run()
+        pool = database.use_pool(min_size=2, max_size=threads)
+        pooled = run()
+        pool.close()
+        print(f"每次建连: {direct:.4f}s, 连接池: {pooled:.4f}s")
+        print(pool.metrics())
+
+
+def benchmark_execute_many(rows=2000):
+    """比较 逐条 execute_sql 与 语句缓存 + execute_many 的插入耗时(sqlite 本地替身)"""
+    with tempfile.TemporaryDirectory() as workdir:
+        database = SQLiteDatabaseWapper(os.path.join(workdir, "bench.db"))
+        database.use_pool(max_size=1)
+        database.execute_sql("create table users (id integer primary key, name text);")
+        sql = "insert into users (name) values (?);"
+        param_rows = [(f"user{i}",) for i in range(rows)]
+
+        start = time.perf_counter()
+        for params in param_rows:
+            database.execute_sql(sql, params)
+        per_call = time.perf_counter() - start
+
+        cache = database.use_statement_cache()
+        start = time.perf_counter()
+        for params in param_rows:
+            database.execute_sql(sql, params)
+        cached = time.perf_counter() - start
+
+        start = time.perf_counter()
+        database.execute_many(sql, iter(param_rows))
+        batched = time.perf_counter() - start
+
+        print(f"逐条执行: {per_call:.4f}s, 语句缓存: {cached:.4f}s, execute_many: {batched:.4f}s")
+        print(cache.metrics())
+
+
+# ---------------------------------------------------------------------------------------------
+# 异步版本: 查询服务运行在 asyncio 上，而上面的整个 DatabaseWapper 体系都是阻塞的
+# 工厂方法的结构保持不变: AsyncDatabaseWapper.create_connection 由子类决定返回哪一种 AsyncConnection
+
+class AsyncConnection(ABC):
+
+    @abstractmethod
+    async def check(self, sql) -> None:
+        pass
+
+    @abstractmethod
+    async def execute(self, sql, params=()) -> None:
+        pass
+
+    async def ping(self) -> bool:
+        return True
+
+    def abort(self) -> None:
+        """查询被取消时调用，连接状态未知，之后不会再被复用"""
+
+    async def close(self) -> None:
+        pass
+
+
+class AsyncMySQLConnection(AsyncConnection):
+
+    async def check(self, sql) -> None:
+        print("mysql语句检查通过")
+
+    async def execute(self, sql, params=()) -> None:
+        print("mysql语句执行成功")
+
+
+class AsyncOracleConnection(AsyncConnection):
+
+    async def check(self, sql) -> None:
+        print("oracle语句检查通过")
+
+    async def execute(self, sql, params=()) -> None:
+        print("oracle语句执行成功")
+
+
+class AsyncSQLiteConnection(AsyncConnection):
+    """
+    本地替身: latency 用于模拟真实数据库驱动中可以 await 的网络往返耗时，
+    本地 sqlite 查询只需几微秒，直接在事件循环中执行比切换到线程更快
+    """
+
+    def __init__(self, database: str, latency: float = 0.0) -> None:
+        self._conn = SQLiteConnection(database)
+        self.latency = latency
+
+    async def check(self, sql) -> None:
+        self._conn.check(sql)
+
+    async def execute(self, sql, params=()) -> list:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._conn.execute(sql, params)
+
+    async def close(self) -> None:
+        self._conn.close()
+
+
+class AsyncConnectionPool:
+    """
+    异步连接池，max_size 同时也是并发上限: 最多 max_size 个查询同时在执行
+    """
+
+    def __init__(self, connection_factory, max_size: int = 10, timeout: float = 30.0) -> None:
+        assert max_size > 0, "max_size must be positive"
+        self._factory = connection_factory
+        self.max_size = max_size
+        self.timeout = timeout
+        self._idle = []
+        # 并发名额: 用一个先进先出的等待队列代替 asyncio.Semaphore + wait_for。
+        # 所有等待者的超时时间相同，队首的截止时间总是最早的，因此整个池只需要一个定时器，
+        # 而不是像 wait_for 那样为每个等待者各建一个任务和定时器
+        self._available = max_size
+        self._waiters = deque()     # (future, deadline)
+        self._timer = None
+
+    def _arm_timer(self) -> None:
+        while self._waiters and self._waiters[0][0].done():
+            self._waiters.popleft()
+        if self._timer is None and self._waiters:
+            self._timer = asyncio.get_running_loop().call_at(self._waiters[0][1], self._expire)
+
+    def _expire(self) -> None:
+        self._timer = None
+        now = asyncio.get_running_loop().time()
+        while self._waiters and self._waiters[0][1] <= now:
+            future, _ = self._waiters.popleft()
+            if not future.done():
+                future.set_exception(PoolTimeout(f"no connection available within {self.timeout}s"))
+        self._arm_timer()
+
+    async def _acquire_slot(self) -> None:
+        if self._available > 0 and not self._waiters:
+            self._available -= 1
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters.append((future, loop.time() + self.timeout))
+        self._arm_timer()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 名额已经转交给我们，但调用者被取消了，归还名额
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._release_slot()
+            raise
+
+    def _release_slot(self) -> None:
+        # 有等待者时直接把名额转交给队首，而不是先放回再被抢
+        while self._waiters:
+            future, _ = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._available += 1
+
+    async def acquire(self) -> AsyncConnection:
+        await self._acquire_slot()
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if await conn.ping():
+                    return conn
+                await conn.close()
+            return await self._factory()
+        except BaseException:
+            self._release_slot()
+            raise
+
+    async def release(self, conn: AsyncConnection, discard: bool = False) -> None:
+        try:
+            if discard:
+                await conn.close()
+            else:
+                self._idle.append(conn)
+        finally:
+            self._release_slot()
+
+    @asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            # 被取消或出错的连接可能处于事务或查询中途，直接丢弃
+            conn.abort()
+            await self.release(conn, discard=True)
+            raise
+        await self.release(conn)
+
+    async def close(self) -> None:
+        while self._idle:
+            await self._idle.pop().close()
+
+
+class AsyncDatabaseWapper:
+    """
+    异步数据库操作类
+    """
+    _pool = None
+
+    @abstractmethod
+    async def create_connection(self) -> AsyncConnection:
+        raise NotImplementedError('`create_connection()` must be implemented.')
+
+    def use_pool(self, **options) -> AsyncConnectionPool:
+        self._pool = AsyncConnectionPool(self.create_connection, **options)
+        return self._pool
+
+    async def execute_sql(self, sql, params=()):
+        """可以被取消: 取消时连接会被中断并丢弃，不会回到连接池"""
+        if self._pool is not None:
+            async with self._pool.connection() as conn:
+                await conn.check(sql)
+                return await conn.execute(sql, params)
+        conn = await self.create_connection()
+        try:
+            await conn.check(sql)
+            return await conn.execute(sql, params)
+        except asyncio.CancelledError:
+            conn.abort()
+            raise
+        finally:
+            await conn.close()
+
+
+class AsyncMySQLDatabaseWapper(AsyncDatabaseWapper):
+
+    async def create_connection(self) -> AsyncConnection:
+        return AsyncMySQLConnection()
+
+
+class AsyncOracleDatabaseWapper(AsyncDatabaseWapper):
+
+    async def create_connection(self) -> AsyncConnection:
+        return AsyncOracleConnection()
+
+
+class AsyncSQLiteDatabaseWapper(AsyncDatabaseWapper):
+
+    def __init__(self, database: str, latency: float = 0.0) -> None:
+        self.database = _require_database_file(database)
+        self.latency = latency
+
+    async def create_connection(self) -> AsyncConnection:
+        return AsyncSQLiteConnection(self.database, self.latency)
+
+
+def benchmark_async(queries=10000, concurrency=64, latency=0.001):
+    """
+    10k 个并发查询: 异步连接池 对比 线程池包装的同步版本
+    两边都用 latency 模拟一次网络往返
+    """
+
+    class SlowSQLiteDatabaseWapper(SQLiteDatabaseWapper):
+        def execute_sql(self, sql, params=()):
+            time.sleep(latency)
+            return super().execute_sql(sql, params)
+
+    def percentile(values, p):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "bench.db")
+        SQLiteDatabaseWapper(path).execute_sql("create table users (id integer primary key, name text);")
+
+        async def run_async():
+            database = AsyncSQLiteDatabaseWapper(path, latency)
+            pool = database.use_pool(max_size=concurrency)
+            latencies = []
+
+            async def one():
+                start = time.perf_counter()
+                await database.execute_sql("select * from users;")
+                latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(queries)))
+            total = time.perf_counter() - start
+            await pool.close()
+            return total, latencies
+
+        def run_threads():
+            database = SlowSQLiteDatabaseWapper(path)
+            database.use_pool(max_size=concurrency)
+            latencies = []
+
+            def one(submitted):
+                database.execute_sql("select * from users;")
+                latencies.append(time.perf_counter() - submitted)
+
+            # 延迟从提交时刻算起，与异步版本一样包含排队时间
+            start = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as executor:
+                for _ in range(queries):
+                    executor.submit(one, time.perf_counter())
+            return time.perf_counter() - start, latencies
+
+        for name, (total, latencies) in (("asyncio", asyncio.run(run_async())), ("线程池", run_threads())):
+            print(f"{name}: {queries / total:.0f} qps, p50 {percentile(latencies, 0.5) * 1000:.1f}ms, "
+                  f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms")
+
+
+# ---------------------------------------------------------------------------------------------
+# 分片路由: QueryApp 只能绑定一个数据库，读请求需要分散到多个数据库实例上
+# ShardRouter 管理多个分片，每个分片有一个主库(写)和若干只读副本(读)，分片本身仍然是普通的 DatabaseWapper
+#   1、按分片键做一致性哈希，增删分片时只有少量键需要迁移
+#   2、分片内的读请求在副本之间轮询
+#   3、跨分片查询并行地发往所有分片，再合并结果(scatter-gather)
+
+class Shard:
+
+    def __init__(self, name: str, primary: DatabaseWapper, replicas=()) -> None:
+        self.name = name
+        self.primary = primary
+        self.replicas = list(replicas) or [primary]
+        self._next_replica = itertools.cycle(self.replicas)
+        self._lock = threading.Lock()
+
+    def replica(self) -> DatabaseWapper:
+        with self._lock:
+            return next(self._next_replica)
+
+
+class ShardRouter:
+
+    def __init__(self, shards, virtual_nodes: int = 128, max_workers: int = None) -> None:
+        self.virtual_nodes = virtual_nodes
+        self._shards = {}
+        self._ring = []
+        for shard in shards:
+            self.add_shard(shard)
+        self._executor = ThreadPoolExecutor(max_workers or max(4, len(self._shards)))
+
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+    def add_shard(self, shard: Shard) -> None:
+        assert shard.name not in self._shards, f"shard {shard.name} already exists"
+        self._shards[shard.name] = shard
+        for i in range(self.virtual_nodes):
+            bisect.insort(self._ring, (self._hash(f"{shard.name}#{i}"), shard.name))
+
+    def remove_shard(self, name: str) -> None:
+        del self._shards[name]
+        self._ring = [node for node in self._ring if node[1] != name]
+
+    def shard_for(self, shard_key) -> Shard:
+        assert self._ring, "no shard available"
+        index = bisect.bisect(self._ring, (self._hash(shard_key),))
+        return self._shards[self._ring[index % len(self._ring)][1]]
+
+    def read(self, shard_key, sql, params=()):
+        return self.shard_for(shard_key).replica().execute_sql(sql, params)
+
+    def write(self, shard_key, sql, params=()):
+        return self.shard_for(shard_key).primary.execute_sql(sql, params)
+
+    def scatter_gather(self, sql, params=()) -> list:
+        """在所有分片上并行执行同一条查询，合并结果"""
+        futures = [self._executor.submit(shard.replica().execute_sql, sql, params)
+                   for shard in self._shards.values()]
+        rows = []
+        for future in futures:
+            rows.extend(future.result() or ())
+        return rows
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+def benchmark_sharding(max_shards=8, queries=4000, threads=32, latency=0.001):
+    """
+    分片数从 1 增加到 max_shards 时的吞吐量
+    每个分片只有一个连接，并用 latency 模拟一次查询的服务端耗时，因此单个分片的吞吐量是有上限的
+    """
+
+    class SlowSQLiteDatabaseWapper(SQLiteDatabaseWapper):
+        def execute_sql(self, sql, params=(), ttl=None):
+            with self._pool.connection() as conn:
+                time.sleep(latency)
+                return conn.execute(sql, params)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        shard_count = 1
+        while shard_count <= max_shards:
+            shards = []
+            for i in range(shard_count):
+                database = SlowSQLiteDatabaseWapper(os.path.join(workdir, f"shard{shard_count}_{i}.db"))
+                database.use_pool(min_size=1, max_size=1)
+                shards.append(Shard(f"shard{i}", database))
+            router = ShardRouter(shards)
+            for i in range(shard_count):
+                shards[i].primary.execute_sql("create table users (id integer primary key, name text);")
+
+            def worker(offset):
+                for user_id in range(offset, queries, threads):
+                    router.read(user_id, "select * from users where id = ?;", (user_id,))
+
+            workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+            start = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            cost = time.perf_counter() - start
+            router.close()
+            print(f"{shard_count} 个分片: {queries / cost:.0f} qps")
+            shard_count *= 2
+
+
 # 应用级别的代码
 class QueryApp:
     
-    def __init__(self, sql_type):
+    def __init__(self, sql_type, result_cache: ResultCache = None):
         
         self.database_client = None
         if sql_type == "mysql":
@@ -80,6 +1016,8 @@ class QueryApp:
             self.database_client = OracleDatabaseWapper()
         
         assert self.database_client, "database_client must not None"
+        if result_cache is not None:
+            self.database_client.use_result_cache(result_cache)
 
     @property
     def query(self):
@@ -92,4 +1030,14 @@ if __name__ == "__main__":
     print(mysql_query.query)
 
     orcle_query = QueryApp("oracle")
-    print(mysql_query.query)
\ No newline at end of file
+    print(mysql_query.query)
+
+    # 开启结果缓存后，第二次访问不会再执行查询
+    cached_query = QueryApp("mysql", LRUResultCache(default_ttl=5))
+    print(cached_query.query)
+    print(cached_query.query)
+
+    benchmark()
+    benchmark_execute_many()
+    benchmark_async()
+    benchmark_sharding()
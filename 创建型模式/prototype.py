@@ -16,6 +16,21 @@
 # ---------------------------------------------------------------------------------------------
 # 使用原型模式，创建版本管理系统v1.0, 我们完全利用python的特性即可
 import copy
+import pickle
+import random
+import time
+import tracemalloc
+
+# 不可变对象可以在原型与副本之间直接共享，无需任何拷贝
+_IMMUTABLE_TYPES = (str, bytes, int, float, complex, bool, type(None), frozenset)
+
+
+def _is_immutable(value) -> bool:
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return True
+    if isinstance(value, tuple):
+        return all(_is_immutable(item) for item in value)
+    return False
 
 
 class Product:
@@ -35,6 +50,313 @@ class Product:
     def copy(self) -> 'Product':
         return copy.copy(self)
 
+    def cow_copy(self) -> 'Product':
+        """
+        共享式克隆: 副本与原型在结构上共享属性。
+            1、不可变属性直接共享，永远不需要拷贝
+            2、原型自己持有的可变属性(例如很大的 content)在第一次克隆时移入原型的共享区，成为只读快照，不做任何拷贝；
+               原型状态不变时，之后的每次克隆都复用同一份快照，克隆一个原型 N 次也只是 N 次字典复制
+            3、快照不会被原地修改: 任何对象(包括原型自己)第一次访问某个可变属性时，复制出属于自己的一份
+        NOTE: Python 无法拦截 content.append(...) 这类原地修改，所以它并不是严格意义上的写时复制，而是首次访问即复制；
+        只读不可变属性、或直接赋值则完全不需要拷贝。
+        原型的可变属性被移入快照之后，外部如果还持有它的引用(例如之前取出的 product.content)，不应再原地修改它
+        """
+        own = self.__dict__
+        moved = [name for name, value in own.items() if name != '_cow_shared' and not _is_immutable(value)]
+        if moved:
+            # 共享区字典属于每个对象自己，修改前先复制，不影响已经生成的副本
+            shared = dict(own.get('_cow_shared', ()))
+            for name in moved:
+                shared[name] = own.pop(name)
+            own['_cow_shared'] = shared
+        clone = object.__new__(type(self))
+        clone.__dict__.update(own)
+        if '_cow_shared' in own:
+            clone.__dict__['_cow_shared'] = dict(own['_cow_shared'])
+        return clone
+
+    def __copy__(self) -> 'Product':
+        # 浅拷贝同样要有自己的共享区字典，否则 cow_copy 对共享区的修改会被另一个对象看到
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        if '_cow_shared' in clone.__dict__:
+            clone.__dict__['_cow_shared'] = dict(clone.__dict__['_cow_shared'])
+        return clone
+
+    def __getattr__(self, name):
+        # 只有在实例 __dict__ 中找不到属性时才会进入这里，正常的属性访问没有任何额外开销
+        shared = self.__dict__.get('_cow_shared')
+        if shared is None or name not in shared:
+            raise AttributeError(name)
+        value = self.__dict__[name] = copy.deepcopy(shared.pop(name))
+        return value
+
+
+# ---------------------------------------------------------------------------------------------
+# 版本管理系统v2.0: 批量克隆
+# 同一个原型要被克隆几十万次，每次只覆盖少量属性，copy.deepcopy 的通用分发(查 memo、查 __reduce_ex__ ...)成为瓶颈
+# 我们为每个原型类生成一个专用的克隆函数: 它知道该类有哪些字段(包括 __slots__)，
+# 不可变字段直接共享，可变字段才深拷贝，被覆盖的字段则连拷贝都省掉
+
+_MISSING = object()
+_clone_functions = {}
+
+
+def _prototype_fields(prototype) -> dict:
+    """返回 字段名 -> 当前值，同时支持 __dict__ 与 __slots__"""
+    fields = {}
+    for klass in reversed(type(prototype).__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name not in ('__dict__', '__weakref__') and hasattr(prototype, name):
+                fields[name] = getattr(prototype, name)
+    instance_dict = getattr(prototype, '__dict__', {})
+    # 共享式克隆的副本，部分字段还放在共享区里；只读取快照本身，不触发 __getattr__ 的复制
+    for name, value in instance_dict.get('_cow_shared', {}).items():
+        fields[name] = value
+    for name, value in instance_dict.items():
+        if name != '_cow_shared':
+            fields[name] = value
+    return fields
+
+
+def _compile_clone_function(cls, layout):
+    lines = [f"def clone_{cls.__name__}(src, overrides):"]
+    lines.append("    if not _field_names.issuperset(overrides):")
+    lines.append("        raise AttributeError(f'unknown fields: {set(overrides) - _field_names}')")
+    lines.append("    obj = _new(_cls)")
+    for name, immutable in layout:
+        lines.append(f"    value = overrides.get({name!r}, _missing)")
+        if immutable:
+            lines.append(f"    obj.{name} = src.{name} if value is _missing else value")
+        else:
+            lines.append(f"    obj.{name} = _deepcopy(src.{name}) if value is _missing else value")
+    lines.append("    return obj")
+    namespace = {
+        "_new": object.__new__,
+        "_cls": cls,
+        "_deepcopy": copy.deepcopy,
+        "_missing": _MISSING,
+        "_field_names": frozenset(name for name, _ in layout),
+    }
+    exec("\n".join(lines), namespace)
+    return namespace[f"clone_{cls.__name__}"]
+
+
+def get_clone_function(prototype):
+    """按 (类, 字段布局) 缓存生成好的克隆函数"""
+    cls = type(prototype)
+    layout = tuple((name, _is_immutable(value)) for name, value in _prototype_fields(prototype).items())
+    key = (cls, layout)
+    try:
+        return _clone_functions[key]
+    except KeyError:
+        function = _clone_functions[key] = _compile_clone_function(cls, layout)
+        return function
+
+
+def clone_many(prototype, overrides_iterable):
+    """以 prototype 为原型批量克隆，overrides_iterable 中的每一项是一次克隆要覆盖的属性"""
+    clone = get_clone_function(prototype)
+    return [clone(prototype, overrides) for overrides in overrides_iterable]
+
+
+class PrototypeRegistry:
+    """原型注册表: 按名称登记原型，需要时从原型克隆"""
+
+    def __init__(self) -> None:
+        # 名称 -> (原型, 克隆函数)，克隆函数在登记时就解析好，克隆时不再分析字段布局
+        # NOTE: 登记之后原型的字段布局(字段集合及其可变性)不应再改变，否则需要重新 register()
+        self._prototypes = {}
+
+    def register(self, name: str, prototype) -> None:
+        self._prototypes[name] = (prototype, get_clone_function(prototype))
+
+    def unregister(self, name: str) -> None:
+        del self._prototypes[name]
+
+    def clone(self, name: str, **overrides):
+        prototype, clone = self._prototypes[name]
+        return clone(prototype, overrides)
+
+    def clone_many(self, name: str, overrides_iterable):
+        prototype, clone = self._prototypes[name]
+        return [clone(prototype, overrides) for overrides in overrides_iterable]
+
+
+def benchmark_clone_many(clones=20000):
+    """比较 copy.deepcopy + 属性更新 与 clone_many 的单次克隆耗时"""
+    prototype = Product("商场管理系统", "mnio", {"tags": ["v1"], "size": 1}, '0.1.0')
+    overrides = [{"version": f"0.1.{i}"} for i in range(clones)]
+
+    start = time.perf_counter()
+    for item in overrides:
+        product = copy.deepcopy(prototype)
+        product.__dict__.update(item)
+    deepcopy_cost = (time.perf_counter() - start) / clones
+
+    start = time.perf_counter()
+    clone_many(prototype, overrides)
+    clone_many_cost = (time.perf_counter() - start) / clones
+
+    print(f"deepcopy:   {deepcopy_cost * 1e6:.2f} us/clone")
+    print(f"clone_many: {clone_many_cost * 1e6:.2f} us/clone ({deepcopy_cost / clone_many_cost:.1f}x)")
+
+
+# ---------------------------------------------------------------------------------------------
+# 版本管理系统v3.0: 增量存储
+# 每个版本都是一份完整拷贝时，N 个版本就要保存 N 份 content。
+# VersionStore 每隔 keyframe_interval 个版本保存一次完整的关键帧，其余版本只保存与上一版本的差异(delta)，
+# 恢复任意版本时从最近的关键帧开始向后应用差异，最多应用 keyframe_interval - 1 个 delta
+
+def _diff(old, new):
+    """计算一个字段的差异，字符串和列表只记录被修改的那一段"""
+    if type(old) is type(new) and isinstance(new, (str, bytes, list, tuple)):
+        limit = min(len(old), len(new))
+        start = 0
+        while start < limit and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < limit - start and old[len(old) - end - 1] == new[len(new) - end - 1]:
+            end += 1
+        return ("splice", start, len(old) - end, copy.deepcopy(new[start:len(new) - end]))
+    return ("set", copy.deepcopy(new))
+
+
+def _patch(old, delta):
+    if delta[0] == "splice":
+        _, start, stop, replacement = delta
+        # 差异中的对象属于存储本身，恢复出来的版本被修改时不能影响它
+        return old[:start] + copy.deepcopy(replacement) + old[stop:]
+    return copy.deepcopy(delta[1])
+
+
+class VersionStore:
+    """
+    关键帧 + 增量 的版本存储，内存占用随修改量增长，而不是随版本数增长
+    """
+
+    def __init__(self, keyframe_interval: int = 32) -> None:
+        assert keyframe_interval > 0, "keyframe_interval must be positive"
+        self.keyframe_interval = keyframe_interval
+        self._entries = []
+        self._last = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def commit(self, product) -> int:
+        """保存一个版本，返回版本号"""
+        fields = _prototype_fields(product)
+        number = len(self._entries)
+        if number % self.keyframe_interval == 0 or self._last is None or fields.keys() != self._last.keys():
+            entry = ("keyframe", type(product), copy.deepcopy(fields))
+        else:
+            delta = {
+                name: _diff(self._last[name], value)
+                for name, value in fields.items()
+                if self._last[name] != value
+            }
+            entry = ("delta", type(product), delta)
+        self._entries.append(entry)
+        self._last = copy.deepcopy(fields)
+        return number
+
+    def _fields(self, number: int) -> dict:
+        if not 0 <= number < len(self._entries):
+            raise IndexError(f"version {number} not found")
+        keyframe = number
+        while self._entries[keyframe][0] != "keyframe":
+            keyframe -= 1
+        fields = copy.deepcopy(self._entries[keyframe][2])
+        for _, _, delta in self._entries[keyframe + 1:number + 1]:
+            for name, change in delta.items():
+                fields[name] = _patch(fields[name], change)
+        return fields
+
+    def checkout(self, number: int):
+        """恢复指定版本"""
+        fields = self._fields(number)
+        product = object.__new__(self._entries[number][1])
+        for name, value in fields.items():
+            setattr(product, name, value)
+        return product
+
+    def size(self) -> int:
+        """以序列化后的字节数估算存储大小"""
+        return len(pickle.dumps(self._entries))
+
+
+def benchmark_version_store(versions=2000, content_lines=500, lookups=1000):
+    """比较 全量拷贝 与 VersionStore 的存储大小及随机版本恢复耗时"""
+    product = Product("商场管理系统", "mnio", [f"line {i}" for i in range(content_lines)], '0.1.0')
+    store = VersionStore()
+    full_history = []
+    for i in range(versions):
+        product.content[i % content_lines] = f"line {i % content_lines} edited in {i}"
+        product.version = f"0.1.{i}"
+        store.commit(product)
+        full_history.append(copy.deepcopy(product))
+
+    print(f"全量拷贝: {len(pickle.dumps(full_history)) / 1024:.0f} KiB")
+    print(f"增量存储: {store.size() / 1024:.0f} KiB")
+
+    numbers = [random.randrange(versions) for _ in range(lookups)]
+    start = time.perf_counter()
+    for number in numbers:
+        restored = store.checkout(number)
+    cost = (time.perf_counter() - start) / lookups
+    assert restored.content == full_history[number].content
+    print(f"随机版本恢复: {cost * 1e6:.1f} us/次")
+
+
+def benchmark(versions=200, content_lines=2000):
+    """
+    比较 deepcopy / copy / cow_copy 生成大量版本时的耗时与内存
+        只改版本号: cow_copy 的最佳情况，content 始终共享
+        同时修改 content: cow_copy 的最差情况，每个版本都要复制一次 content
+    NOTE: copy 是浅拷贝，修改 content 时所有版本会互相影响，这里只作为耗时的下限参考
+    """
+    content = [{"line": i, "text": f"line {i}"} for i in range(content_lines)]
+
+    for edit_content in (False, True):
+        print("同时修改 content:" if edit_content else "只修改版本号:")
+        for method in ("deepcopy", "copy", "cow_copy"):
+            product = Product("商场管理系统", "mnio", copy.deepcopy(content), '0.1.0')
+            history = []
+            tracemalloc.start()
+            start = time.perf_counter()
+            for i in range(versions):
+                product = getattr(product, method)()
+                product.version = f"0.1.{i}"
+                if edit_content:
+                    product.content[i % content_lines]["text"] = f"edited in {i}"
+                history.append(product)
+            cost = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"\t{method:>9}: {cost:.4f}s, 峰值内存 {peak / 1024 / 1024:.2f} MiB")
+
+
+def benchmark_fanout(clones=200, content_lines=5000):
+    """同一个原型克隆 clones 次: 模板式的用法，原型本身不变"""
+    content = [{"line": i, "text": f"line {i}"} for i in range(content_lines)]
+    for method in ("deepcopy", "cow_copy"):
+        prototype = Product("商场管理系统", "mnio", copy.deepcopy(content), '0.1.0')
+        clones_made = []
+        tracemalloc.start()
+        start = time.perf_counter()
+        for i in range(clones):
+            product = getattr(prototype, method)()
+            product.version = f"0.1.{i}"
+            clones_made.append(product)
+        cost = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"\t{method:>9}: 克隆 {clones} 次 {cost:.4f}s, 峰值内存 {peak / 1024 / 1024:.2f} MiB")
+
 
 if  __name__=="__main__":
 
@@ -46,4 +368,19 @@ if  __name__=="__main__":
     product_v2.version = '1.0.0'
     print(product_v2)
 
-    
\ No newline at end of file
+    # 写时复制: 只修改版本号时，content 不会被复制
+    product_v3 = product_v2.cow_copy()
+    product_v3.version = '1.0.1'
+    print(product_v3, product_v3.content)
+
+    benchmark()
+    benchmark_fanout()
+
+    registry = PrototypeRegistry()
+    registry.register("mall", product_v1)
+    for product in registry.clone_many("mall", [{"version": "2.0.0"}, {"version": "2.0.1", "content": "hotfix"}]):
+        print(product)
+
+    benchmark_clone_many()
+
+    benchmark_version_store()
@@ -10,6 +10,13 @@
 这些场景希望程序在运行过程中只生成一个实例，避免对同一资源产生相互冲突的请求
 """
 
+import asyncio
+import contextvars
+import os
+import threading
+import time
+import weakref
+
 
 class Singleton(object):
 
@@ -21,8 +28,385 @@ class Singleton(object):
         # 否则返回该实例
         return cls._instance
 
+
+# ---------------------------------------------------------------------------------------------
+# 上面的 Singleton 有几个问题:
+#   1、hasattr 判断与赋值之间没有加锁，多线程同时启动时，昂贵的资源(日志写入器、数据库句柄)可能会被创建两次
+#   2、_instance 是类属性，子类会通过继承"看到"父类的实例，父类先实例化后子类拿到的就是父类对象
+#   3、os.fork 之后子进程会直接继承父进程的实例(以及它持有的文件句柄、连接)
+# 于是我们采用元类来控制实例化过程: 无锁的快速路径 + 首次创建时的双重检查锁
+
+# 所有使用 SingletonMeta 的类，fork 之后需要在子进程中逐一重置
+# 使用弱引用: 函数内部临时定义的单例类(例如 benchmark 中的)不再使用后可以被回收
+_singleton_classes = weakref.WeakSet()
+
+
+class SingletonMeta(type):
+    """
+    线程安全、感知 fork 的单例元类
+
+    每个使用该元类的类(包括子类)都有自己独立的实例登记表与锁，
+    实例创建之后的访问只是一次字典查找，不需要获取锁。
+    """
+
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        # 注意: 这里直接写入 cls 自己的 __dict__，子类不会共享父类的登记表
+        cls._singleton_instances = {}
+        cls._singleton_lock = threading.Lock()
+        _singleton_classes.add(cls)
+
+    def __call__(cls, *args, **kwargs):
+        # 快速路径: 实例已经存在，直接返回，不加锁
+        instances = cls.__dict__['_singleton_instances']
+        try:
+            return instances[cls]
+        except KeyError:
+            pass
+        # 慢速路径: 双重检查锁，保证只会构建一次
+        with cls.__dict__['_singleton_lock']:
+            if cls not in instances:
+                instances[cls] = super().__call__(*args, **kwargs)
+            return instances[cls]
+
+    def reset_instance(cls) -> None:
+        """丢弃当前实例，下一次调用将重新创建"""
+        with cls.__dict__['_singleton_lock']:
+            cls.__dict__['_singleton_instances'].clear()
+
+
+def _reset_singletons_after_fork() -> None:
+    # fork 时其他线程可能正持有锁，子进程中该锁将永远不会被释放，所以锁也要重新创建
+    for cls in _singleton_classes:
+        cls._singleton_lock = threading.Lock()
+        cls._singleton_instances.clear()
+    ProcessScopedSingletonMeta._lock = threading.Lock()
+    for cls in _process_scoped_classes:
+        cls._process_singleton_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_singletons_after_fork)
+
+
+# ---------------------------------------------------------------------------------------------
+# 并发基准: 比较 __new__ 方式和元类方式在 1~64 个线程同时获取实例时的耗时
+
+def benchmark(thread_counts=(1, 2, 4, 8, 16, 32, 64), calls=20000):
+
+    class NewSingleton(Singleton):
+        pass
+
+    class MetaSingleton(metaclass=SingletonMeta):
+        pass
+
+    def run(factory, threads):
+        barrier = threading.Barrier(threads + 1)
+        seen = set()
+
+        def worker():
+            barrier.wait()
+            for _ in range(calls):
+                instance = factory()
+            seen.add(id(instance))
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for w in workers:
+            w.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for w in workers:
+            w.join()
+        return time.perf_counter() - start, len(seen)
+
+    print(f"{'threads':>8} {'__new__(s)':>12} {'meta(s)':>12} {'instances':>10}")
+    for threads in thread_counts:
+        # 每一轮都从"尚未创建"开始，这样才能测到首次创建时的竞争
+        if '_instance' in NewSingleton.__dict__:
+            del NewSingleton._instance
+        MetaSingleton.reset_instance()
+        new_cost, new_seen = run(NewSingleton, threads)
+        meta_cost, meta_seen = run(MetaSingleton, threads)
+        print(f"{threads:>8} {new_cost:>12.4f} {meta_cost:>12.4f} {f'{new_seen}/{meta_seen}':>10}")
+
+
+# ---------------------------------------------------------------------------------------------
+# 作用域单例: 全局只有一个可变实例时，所有请求处理器都要抢同一把锁，它就成了热点
+# 如果实例只需要在某个"作用域"内唯一，那就可以给每个线程 / 每个 contextvars 上下文 / 每个进程各一份，
+# 作用域内部不存在共享，自然也不需要锁。使用方式与 SingletonMeta 相同，只需更换元类
+
+class ScopedSingletonMeta(type):
+    """
+    作用域单例元类的基类，子类通过 _scope_registry() 返回当前作用域的实例登记表；不适合用登记表表示的作用域可以直接重写 __call__ 与 reset_instance()
+    """
+
+    def _scope_registry(cls) -> dict:
+        raise NotImplementedError('`_scope_registry()` must be implemented.')
+
+    def __call__(cls, *args, **kwargs):
+        registry = cls._scope_registry()
+        try:
+            return registry[cls]
+        except KeyError:
+            instance = registry[cls] = super().__call__(*args, **kwargs)
+            return instance
+
+    def reset_instance(cls) -> None:
+        """丢弃当前作用域中的实例"""
+        cls._scope_registry().pop(cls, None)
+
+
+class ThreadScopedSingletonMeta(ScopedSingletonMeta):
+    """每个线程一个实例"""
+
+    _local = threading.local()
+
+    def _scope_registry(cls) -> dict:
+        try:
+            return ThreadScopedSingletonMeta._local.registry
+        except AttributeError:
+            registry = ThreadScopedSingletonMeta._local.registry = {}
+            return registry
+
+
+class ContextScopedSingletonMeta(ScopedSingletonMeta):
+    """
+    每个 contextvars 上下文一个实例
+    每个类有自己的 ContextVar，直接保存实例本身，而不是一个共享的可变登记表:
+    asyncio 创建任务时会复制当前上下文，父上下文中已经创建的实例会被子任务继承，
+    但子任务中新创建的实例只属于该子任务，兄弟任务之间互不可见
+    """
+
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        cls._context_instance = contextvars.ContextVar(f"{cls.__qualname__}.instance", default=None)
+
+    def __call__(cls, *args, **kwargs):
+        var = cls.__dict__['_context_instance']
+        instance = var.get()
+        if instance is None:
+            instance = type.__call__(cls, *args, **kwargs)
+            var.set(instance)
+        return instance
+
+    def reset_instance(cls) -> None:
+        cls.__dict__['_context_instance'].set(None)
+
+
+# 所有使用 ProcessScopedSingletonMeta 的类，fork 之后需要在子进程中重建它们的锁
+_process_scoped_classes = weakref.WeakSet()
+
+
+class ProcessScopedSingletonMeta(ScopedSingletonMeta):
+    """每个进程一个实例，fork 出来的子进程不会复用父进程的实例"""
+
+    _registries = {}
+    # 只保护 _registries，不在持有它时构建实例
+    _lock = threading.Lock()
+
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        # 与 SingletonMeta 相同，每个类一把锁: 一个单例的 __init__ 中创建另一个单例不会死锁
+        cls._process_singleton_lock = threading.Lock()
+        _process_scoped_classes.add(cls)
+
+    def _scope_registry(cls) -> dict:
+        pid = os.getpid()
+        try:
+            return ProcessScopedSingletonMeta._registries[pid]
+        except KeyError:
+            pass
+        with ProcessScopedSingletonMeta._lock:
+            registries = ProcessScopedSingletonMeta._registries
+            if pid not in registries:
+                # 进程号变化说明已经 fork，父进程的实例全部丢弃
+                registries.clear()
+                registries[pid] = {}
+            return registries[pid]
+
+    def __call__(cls, *args, **kwargs):
+        # 进程作用域内依然会有多个线程，因此首次创建需要加锁
+        registry = cls._scope_registry()
+        try:
+            return registry[cls]
+        except KeyError:
+            pass
+        with cls.__dict__['_process_singleton_lock']:
+            if cls not in registry:
+                registry[cls] = type.__call__(cls, *args, **kwargs)
+            return registry[cls]
+
+
+def benchmark_scoped(threads=8, calls=100000):
+    """作用域单例(无锁) 与 全局单例 + 锁 的吞吐量对比"""
+
+    class GlobalCounter(metaclass=SingletonMeta):
+        def __init__(self):
+            self.value = 0
+            self.lock = threading.Lock()
+
+    class ThreadCounter(metaclass=ThreadScopedSingletonMeta):
+        def __init__(self):
+            self.value = 0
+
+    class ContextCounter(metaclass=ContextScopedSingletonMeta):
+        def __init__(self):
+            self.value = 0
+
+    def global_worker():
+        for _ in range(calls):
+            counter = GlobalCounter()
+            with counter.lock:
+                counter.value += 1
+
+    def scoped_worker(counter_class):
+        def worker():
+            for _ in range(calls):
+                counter_class().value += 1
+        return worker
+
+    def run(worker):
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return threads * calls / (time.perf_counter() - start)
+
+    print(f"全局单例 + 锁: {run(global_worker):>12.0f} ops/s")
+    print(f"线程作用域:    {run(scoped_worker(ThreadCounter)):>12.0f} ops/s")
+    # 每个线程启动时都有自己独立的上下文
+    print(f"上下文作用域:  {run(scoped_worker(ContextCounter)):>12.0f} ops/s")
+
+
+# ---------------------------------------------------------------------------------------------
+# 异步单例: 连接池、模型文件这类资源需要几秒钟才能初始化完成，在 __new__ 里同步创建会阻塞整个事件循环
+# AsyncSingleton 把初始化放到协程 initialize() 中，通过 await Resource.instance() 获取实例，
+# 无论同一时刻有多少协程在请求，initialize() 都只会执行一次，其余协程等待同一个任务的结果
+
+class AsyncSingleton:
+    """
+    异步懒加载单例，子类重写 initialize() / close() 即可
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 每个子类拥有自己独立的状态
+        cls._async_instance = None
+        cls._async_task = None
+        cls._async_metrics = {"requests": 0, "waiters": 0, "time_to_first_instance": None}
+
+    async def initialize(self) -> None:
+        """执行耗时的异步初始化"""
+
+    async def close(self) -> None:
+        """异步释放资源"""
+
+    @classmethod
+    async def _build(cls) -> 'AsyncSingleton':
+        start = time.perf_counter()
+        instance = cls()
+        try:
+            await instance.initialize()
+        except asyncio.CancelledError:
+            # 初始化被 shutdown() 取消，释放已经获取到的部分资源
+            await instance.close()
+            raise
+        cls._async_instance = instance
+        if cls._async_metrics["time_to_first_instance"] is None:
+            cls._async_metrics["time_to_first_instance"] = time.perf_counter() - start
+        return instance
+
+    @classmethod
+    async def instance(cls) -> 'AsyncSingleton':
+        cls._async_metrics["requests"] += 1
+        # 快速路径: 已经初始化完成
+        if cls._async_instance is not None:
+            return cls._async_instance
+        # 事件循环是单线程的，检查与赋值之间没有 await，因此不需要锁
+        if cls._async_task is None:
+            cls._async_task = asyncio.ensure_future(cls._build())
+        else:
+            cls._async_metrics["waiters"] += 1
+        task = cls._async_task
+        try:
+            # shield: 某个等待者被取消时，不应该连带取消正在进行的初始化
+            instance = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # 初始化任务被 shutdown() 取消，而不是当前调用者自己被取消
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                raise RuntimeError(f"{cls.__name__} was shut down during initialization") from None
+            raise
+        except BaseException:
+            # 初始化失败时清理任务，让下一次调用重新尝试
+            if task.done() and (task.cancelled() or task.exception() is not None):
+                if cls._async_task is task:
+                    cls._async_task = None
+            raise
+        # 初始化完成到等待者恢复执行之间，实例可能已经被 shutdown() 关闭
+        if cls._async_task is not task:
+            raise RuntimeError(f"{cls.__name__} was shut down during initialization")
+        return instance
+
+    @classmethod
+    async def shutdown(cls) -> None:
+        task, cls._async_task = cls._async_task, None
+        instance, cls._async_instance = cls._async_instance, None
+        if task is not None and not task.done():
+            # 初始化尚未完成: 取消它，正在等待的调用者会收到 RuntimeError，而不是一个已关闭的实例
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    # shutdown() 自身被取消
+                    raise
+            except Exception:
+                pass
+            else:
+                # 取消请求到达之前初始化已经完成
+                instance = task.result()
+            cls._async_instance = None
+        if instance is not None:
+            await instance.close()
+
+    @classmethod
+    def metrics(cls) -> dict:
+        return dict(cls._async_metrics)
+
+
 if __name__=="__main__" :
     s1 = Singleton()
     s2 = Singleton()
     # s1,s2将会指向同一个对象
-    print(s1, s2)
\ No newline at end of file
+    print(s1, s2)
+
+    class Logger(metaclass=SingletonMeta):
+        pass
+
+    class AuditLogger(Logger):
+        pass
+
+    # Logger 与 AuditLogger 各自只有一个实例，互不影响
+    print(Logger() is Logger(), AuditLogger() is AuditLogger(), Logger() is AuditLogger())
+
+    benchmark()
+    benchmark_scoped()
+
+    class ModelFile(AsyncSingleton):
+
+        async def initialize(self) -> None:
+            # 模拟加载模型文件
+            await asyncio.sleep(0.5)
+            print("模型文件加载完成")
+
+        async def close(self) -> None:
+            print("模型文件已释放")
+
+    async def main():
+        models = await asyncio.gather(*(ModelFile.instance() for _ in range(5000)))
+        print(len({id(m) for m in models}), ModelFile.metrics())
+        await ModelFile.shutdown()
+
+    asyncio.run(main())
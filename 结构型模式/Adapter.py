@@ -10,6 +10,19 @@
 使用一个特定的封装，一些特定的编写办法，使不同的接口可以使用同种调用方式使用。
 """
 
+import hashlib
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+
 class HuaweiCloud:
 
     def upload(self):
@@ -54,7 +67,371 @@ class AdapterCloud:
         self.cloud().tencent_upload()
 
 
+# ---------------------------------------------------------------------------------------------
+# AdapterCloud 有两个问题:
+#   1、每次 upload() 都会执行 self.cloud() 重新创建一个腾讯云客户端
+#   2、每接入一家接口不标准的云厂商，都要手写一个新的适配器类
+# MethodMappingAdapter 只需要一份方法名映射，在构造时创建一次客户端并把目标方法解析、绑定到适配器实例上，
+# 之后的调用就是直接调用绑定方法，没有任何额外的转发开销
+
+class MethodMappingAdapter:
+
+    def __init__(self, adaptee, **mapping) -> None:
+        """
+        adaptee: 被适配的类或实例，传入类时只会实例化一次
+        mapping: 统一的方法名=被适配对象的方法名，例如 upload="tencent_upload"
+        """
+        self.adaptee = adaptee() if isinstance(adaptee, type) else adaptee
+        for name, target in mapping.items():
+            method = getattr(self.adaptee, target, None)
+            if not callable(method):
+                raise AttributeError(f"{type(self.adaptee).__name__} has no method `{target}`")
+            setattr(self, name, method)
+
+    def __repr__(self) -> str:
+        return f"<MethodMappingAdapter for {type(self.adaptee).__name__}>"
+
+
+def benchmark_method_mapping(calls=1000000):
+    """比较 直接调用、MethodMappingAdapter、AdapterCloud 每次调用的开销"""
+
+    class QuietTencentCloud(TencentCloud):
+        def tencent_upload(self):
+            pass
+
+    client = QuietTencentCloud()
+    # 适配器的构造与绑定在循环外完成，这里只测每次调用的成本
+    adapter = MethodMappingAdapter(QuietTencentCloud, upload="tencent_upload")
+    legacy = AdapterCloud(QuietTencentCloud)
+    for name, call in (
+        ("直接调用", lambda: client.tencent_upload()),
+        ("MethodMappingAdapter", lambda: adapter.upload()),
+        ("AdapterCloud", lambda: legacy.upload()),
+    ):
+        start = time.perf_counter()
+        for _ in range(calls):
+            call()
+        print(f"{name:>20}: {(time.perf_counter() - start) / calls * 1e9:.0f} ns/次")
+
+
+# ---------------------------------------------------------------------------------------------
+# 统一的流式上传适配器
+# 上面的 upload() 都是阻塞的、一次性上传整个对象，大文件既占内存又慢。
+# 各家云的分片上传接口同样千奇百怪，我们先定义统一的分片上传接口 UploadBackend，
+# 每家云实现(适配)这个接口，StreamingUploadAdapter 负责:
+#   1、按 part_size 分块缓冲读取文件，同一时刻最多只有 max_in_flight 个分块在内存中，内存占用与文件大小无关
+#   2、用有界线程池并发上传分块
+#   3、失败的分块按指数退避重试
+
+
+class UploadBackend(ABC):
+
+    @abstractmethod
+    def create_multipart(self, key: str) -> str:
+        """开始一次分片上传，返回 upload_id"""
+
+    @abstractmethod
+    def upload_part(self, upload_id: str, part_number: int, data) -> str:
+        """上传一个分片，返回该分片的标识(etag)"""
+
+    @abstractmethod
+    def complete(self, upload_id: str, parts: list) -> None:
+        """按 part_number 顺序合并所有分片"""
+
+    @abstractmethod
+    def abort(self, upload_id: str) -> None:
+        """放弃本次上传，清理已上传的分片"""
+
+
+class LocalFileBackend(UploadBackend):
+    """
+    本地替身: 分片写入 root/.multipart/<upload_id>/ 目录，合并后保存为 root/<key>
+        latency: 每个分片模拟的网络耗时
+        failure_rate: 分片随机失败的概率，用于验证重试
+    """
+
+    def __init__(self, root: str, latency: float = 0.0, failure_rate: float = 0.0) -> None:
+        self.root = root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._uploads = {}
+        self._lock = threading.Lock()
+
+    def create_multipart(self, key: str) -> str:
+        upload_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.root, ".multipart", upload_id))
+        with self._lock:
+            self._uploads[upload_id] = key
+        return upload_id
+
+    def upload_part(self, upload_id: str, part_number: int, data) -> str:
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise ConnectionError(f"part {part_number} upload failed")
+        with open(os.path.join(self.root, ".multipart", upload_id, f"{part_number:08d}"), "wb") as f:
+            f.write(data)
+        return f"{upload_id}-{part_number}"
+
+    def complete(self, upload_id: str, parts: list) -> None:
+        with self._lock:
+            key = self._uploads.pop(upload_id)
+        part_dir = os.path.join(self.root, ".multipart", upload_id)
+        target = os.path.join(self.root, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as out:
+            for part_number, _ in sorted(parts):
+                with open(os.path.join(part_dir, f"{part_number:08d}"), "rb") as part:
+                    shutil.copyfileobj(part, out)
+        shutil.rmtree(part_dir)
+
+    def abort(self, upload_id: str) -> None:
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+        shutil.rmtree(os.path.join(self.root, ".multipart", upload_id), ignore_errors=True)
+
+
+class StreamingUploadAdapter:
+
+    # 只重试传输层的临时错误；FileNotFoundError、PermissionError 等 OSError 重试也不会成功
+    retry_exceptions = (ConnectionError, TimeoutError)
+
+    def __init__(self, backend: UploadBackend, part_size: int = 8 * 1024 * 1024, max_workers: int = 4,
+                 max_retries: int = 3, retry_backoff: float = 0.1, max_in_flight: int = None) -> None:
+        assert part_size > 0 and max_workers > 0, "part_size and max_workers must be positive"
+        self.backend = backend
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_in_flight = max_in_flight or max_workers * 2
+
+    def _upload_part(self, upload_id, part_number, data, slots):
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    return part_number, self.backend.upload_part(upload_id, part_number, data)
+                except self.retry_exceptions:
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(self.retry_backoff * 2 ** attempt)
+        finally:
+            # 分块上传结束，释放一个名额，读取线程才能继续读下一块
+            slots.release()
+
+    def upload(self, path: str, key: str) -> int:
+        """上传文件，返回上传的字节数"""
+        upload_id = self.backend.create_multipart(key)
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        futures = []
+        size = 0
+        executor = ThreadPoolExecutor(self.max_workers)
+        failed = False
+        try:
+            with open(path, "rb") as f:
+                part_number = 1
+                while True:
+                    slots.acquire()
+                    data = f.read(self.part_size)
+                    if not data and part_number > 1:
+                        slots.release()
+                        break
+                    size += len(data)
+                    futures.append(executor.submit(self._upload_part, upload_id, part_number, data, slots))
+                    # 出错时尽早停止读取
+                    if any(future.done() and future.exception() for future in futures[-self.max_in_flight:]):
+                        break
+                    part_number += 1
+                    if len(data) < self.part_size:
+                        break
+            parts = [future.result() for future in futures]
+            self.backend.complete(upload_id, parts)
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            # 某个分块彻底失败后取消还在排队的分块，等正在上传的结束后再 abort，避免 abort 之后仍有分块写入
+            executor.shutdown(wait=True, cancel_futures=failed)
+            if failed:
+                self.backend.abort(upload_id)
+        return size
+
+
+def benchmark(file_size=64 * 1024 * 1024, part_size=1024 * 1024, latency=0.02):
+    """分块并发数从 1 增加到 16 时的吞吐量与峰值内存"""
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "source.bin")
+        with open(path, "wb") as f:
+            for _ in range(file_size // part_size):
+                f.write(os.urandom(part_size))
+        backend = LocalFileBackend(os.path.join(workdir, "bucket"), latency=latency, failure_rate=0.01)
+        for workers in (1, 2, 4, 8, 16):
+            adapter = StreamingUploadAdapter(backend, part_size=part_size, max_workers=workers, retry_backoff=0.01)
+            tracemalloc.start()
+            start = time.perf_counter()
+            adapter.upload(path, f"copy{workers}.bin")
+            cost = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert os.path.getsize(os.path.join(workdir, "bucket", f"copy{workers}.bin")) == file_size
+            print(f"{workers:>2} 并发: {file_size / cost / 1024 / 1024:.1f} MiB/s, 峰值内存 {peak / 1024 / 1024:.1f} MiB")
+
+
+# ---------------------------------------------------------------------------------------------
+# 去重上传: 上传任务会把成千上万个没有变化的文件重新上传一遍
+# DedupUploader 流式计算文件摘要，在本地持久化索引中查找该后端是否已经上传过相同的(路径, 内容)，有则跳过。
+# 索引文件的格式非常紧凑: 每条记录就是 32 字节的 sha256 摘要，追加写入，启动时一次读入即可
+
+_DIGEST_SIZE = hashlib.sha256().digest_size
+# 索引记录: sha256(key) + sha256(文件内容)，定长便于截断崩溃时写了一半的记录
+_RECORD_SIZE = _DIGEST_SIZE * 2
+
+
+def file_digest(path: str, buffer_size: int = 1024 * 1024) -> bytes:
+    """流式计算 sha256(文件内容)，内存占用与文件大小无关"""
+    digest = hashlib.sha256()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.digest()
+
+
+def key_digest(key: str) -> bytes:
+    return hashlib.sha256(key.encode("utf-8")).digest()
+
+
+class DedupIndex:
+    """
+    每个后端一个索引文件: <directory>/<backend>.idx
+    记录每个 key 最近一次上传的内容摘要，文件只追加，加载时同一个 key 以最后一条记录为准
+    """
+
+    def __init__(self, directory: str, backend: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{backend}.idx")
+        self._latest = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                data = f.read()
+            # 上次写入时进程崩溃可能留下不完整的记录，丢弃即可
+            usable = len(data) - len(data) % _RECORD_SIZE
+            view = memoryview(data)
+            for i in range(0, usable, _RECORD_SIZE):
+                self._latest[bytes(view[i:i + _DIGEST_SIZE])] = bytes(view[i + _DIGEST_SIZE:i + _RECORD_SIZE])
+            if usable != len(data):
+                with open(self.path, "r+b") as f:
+                    f.truncate(usable)
+        self._file = open(self.path, "ab")
+
+    def latest(self, key: str) -> bytes:
+        """key 最近一次上传的内容摘要，没有上传过返回 None"""
+        return self._latest.get(key_digest(key))
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+    def add(self, key: str, digest: bytes) -> None:
+        assert len(digest) == _DIGEST_SIZE, "invalid digest"
+        hashed_key = key_digest(key)
+        with self._lock:
+            if self._latest.get(hashed_key) == digest:
+                return
+            self._file.write(hashed_key + digest)
+            self._file.flush()
+            self._latest[hashed_key] = digest
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class DedupUploader:
+    """
+    upload: 任意 upload(path, key) 形式的上传函数，例如 StreamingUploadAdapter(...).upload
+    """
+
+    def __init__(self, upload, index: DedupIndex) -> None:
+        self._upload = upload
+        self.index = index
+        self._metrics = {"uploaded": 0, "skipped": 0, "bytes_uploaded": 0, "bytes_saved": 0,
+                         "lookups": 0, "lookup_time": 0.0}
+
+    def upload(self, path: str, key: str) -> bool:
+        """返回 True 表示真正执行了上传，False 表示内容未变化被跳过"""
+        digest = file_digest(path)
+        size = os.path.getsize(path)
+        start = time.perf_counter()
+        # 只和该 key 最近一次上传的内容比较，A -> B -> A 这样改回去的文件也会重新上传
+        unchanged = self.index.latest(key) == digest
+        self._metrics["lookup_time"] += time.perf_counter() - start
+        self._metrics["lookups"] += 1
+        if unchanged:
+            self._metrics["skipped"] += 1
+            self._metrics["bytes_saved"] += size
+            return False
+        self._upload(path, key)
+        # 上传成功之后才写入索引，上传失败下次会重试
+        self.index.add(key, digest)
+        self._metrics["uploaded"] += 1
+        self._metrics["bytes_uploaded"] += size
+        return True
+
+    def metrics(self) -> dict:
+        metrics = dict(self._metrics)
+        lookups = metrics.pop("lookups")
+        metrics["avg_lookup_ns"] = metrics.pop("lookup_time") / lookups * 1e9 if lookups else 0.0
+        return metrics
+
+
+def benchmark_dedup(files=2000, file_size=64 * 1024, changed_ratio=0.05, index_size=1000000):
+    """第二次上传时只有 changed_ratio 的文件有变化"""
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "source")
+        os.makedirs(source)
+        paths = []
+        for i in range(files):
+            path = os.path.join(source, f"{i}.bin")
+            with open(path, "wb") as f:
+                f.write(os.urandom(file_size))
+            paths.append(path)
+
+        # 先放入大量历史记录，测试大索引的加载时间
+        index_dir = os.path.join(workdir, "index")
+        os.makedirs(index_dir)
+        with open(os.path.join(index_dir, "local.idx"), "wb") as f:
+            f.write(os.urandom(_RECORD_SIZE * index_size))
+        start = time.perf_counter()
+        index = DedupIndex(index_dir, "local")
+        print(f"加载 {len(index)} 条索引: {time.perf_counter() - start:.3f}s, "
+              f"文件大小 {os.path.getsize(index.path) / 1024 / 1024:.1f} MiB")
+
+        adapter = StreamingUploadAdapter(LocalFileBackend(os.path.join(workdir, "bucket")), part_size=file_size)
+        uploader = DedupUploader(adapter.upload, index)
+        for path in paths:
+            uploader.upload(path, os.path.basename(path))
+
+        for path in random.sample(paths, int(files * changed_ratio)):
+            with open(path, "r+b") as f:
+                f.write(os.urandom(16))
+        uploader = DedupUploader(adapter.upload, index)
+        start = time.perf_counter()
+        for path in paths:
+            uploader.upload(path, os.path.basename(path))
+        print(f"第二次上传: {time.perf_counter() - start:.3f}s, {uploader.metrics()}")
+        index.close()
+
+
 if __name__ == "__main__":
     HuaweiCloud().upload()
     AliCloud().upload()
-    AdapterCloud(TencentCloud).upload()
\ No newline at end of file
+    AdapterCloud(TencentCloud).upload()
+    MethodMappingAdapter(TencentCloud, upload="tencent_upload").upload()
+
+    benchmark_method_mapping()
+    benchmark()
+    benchmark_dedup()
\ No newline at end of file
@@ -43,7 +43,22 @@ def pay(pay, pay_type):
 # ---------------------------------------------------------------------------------------------
 # 采用桥接模式
 
+import asyncio
+import contextlib
+import functools
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
 from abc import ABC, abstractmethod
+from array import array
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+from concurrent.futures import ThreadPoolExecutor
 
 
 class IPayType:
@@ -76,14 +91,95 @@ class TouchPay(IPayType):
         print(f"向{user}支付{money}元")
 
 
+# 校验令牌缓存: 人脸、指纹校验是支付中最慢的一步，校验通过后在有效期内不必重复校验
+class VerificationTokenCache:
+
+    def __init__(self, ttl: float = 300.0) -> None:
+        self.ttl = ttl
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, pay_type: IPayType) -> str:
+        """返回有效的校验令牌，必要时执行一次 pay_check()"""
+        now = time.monotonic()
+        with self._lock:
+            token = self._tokens.get(id(pay_type))
+            if token is not None and token[1] > now and token[2] is pay_type:
+                self.hits += 1
+                return token[0]
+            self.misses += 1
+        pay_type.pay_check()
+        token = (uuid.uuid4().hex, time.monotonic() + self.ttl, pay_type)
+        with self._lock:
+            self._tokens[id(pay_type)] = token
+        return token[0]
+
+    def revoke(self, pay_type: IPayType) -> None:
+        with self._lock:
+            self._tokens.pop(id(pay_type), None)
+
+
+PayResult = namedtuple("PayResult", ["user", "money", "ok", "error"])
+
+
+PaymentEvent = namedtuple("PaymentEvent", ["merchant", "channel", "cents"])
+
+
+def to_cents(money) -> int:
+    """元 -> 分，按十进制四舍五入; round(money * 100) 会受二进制浮点误差影响，例如 1.005 * 100 = 100.49999999999999"""
+    return int((Decimal(str(money)) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
 class IPayClient(IPayType):
 
-    def __init__(self, pay_type: IPayType) -> None:
+    def __init__(self, pay_type: IPayType, token_cache: VerificationTokenCache = None) -> None:
         self.pay_type = pay_type
+        self.token_cache = token_cache or VerificationTokenCache()
+        self._listeners = []
+        self.listener_errors = 0
+        self.last_listener_error = None
+
+    def add_listener(self, listener) -> None:
+        """
+        listener(PaymentEvent) 会在每笔支付成功后被调用，例如结算聚合器
+        支付已经完成，listener 抛出的异常不会影响支付结果，只计入 listener_errors
+        """
+        self._listeners.append(listener)
+
+    def _emit(self, user: str, money: float) -> None:
+        if self._listeners:
+            event = PaymentEvent(user, type(self).__name__, to_cents(money))
+            for listener in self._listeners:
+                try:
+                    listener(event)
+                except Exception as error:
+                    self.listener_errors += 1
+                    self.last_listener_error = error
 
     def pay(self, user: str, money: float):
         self.pay_type.pay_check()
         self.pay_type.pay_to(user, money)
+        self._emit(user, money)
+
+    def pay_many(self, payments) -> list:
+        """
+        批量支付: payments 为 [(user, money), ...]
+        一个会话只校验一次，之后一次遍历完成所有支付，单笔失败不影响其他支付
+        """
+        self.token_cache.verify(self.pay_type)
+        pay_to = self.pay_type.pay_to
+        results = []
+        for user, money in payments:
+            try:
+                pay_to(user, money)
+            except Exception as error:
+                results.append(PayResult(user, money, False, error))
+            else:
+                results.append(PayResult(user, money, True, None))
+                self._emit(user, money)
+        return results
 
 
 class AliPay(IPayClient):
@@ -92,6 +188,10 @@ class AliPay(IPayClient):
         print("正在使用支付宝支付...")
         return super().pay(user, money)
 
+    def pay_many(self, payments) -> list:
+        print("正在使用支付宝批量支付...")
+        return super().pay_many(payments)
+
 
 class WechatPay(IPayClient):
 
@@ -99,6 +199,10 @@ class WechatPay(IPayClient):
         print("正在使用微信支付...")
         return super().pay(user, money)
 
+    def pay_many(self, payments) -> list:
+        print("正在使用微信批量支付...")
+        return super().pay_many(payments)
+
 
 class Application:
 
@@ -114,3 +218,392 @@ Application().run()
 人脸识别校验通过
 向王记小笼包支付20元
 """
+
+
+# ---------------------------------------------------------------------------------------------
+# 批量支付的吞吐量: 逐笔 pay() 每一笔都要校验一次，pay_many() 每个会话只校验一次
+
+class SimulatedFacePay(FacePay):
+
+    def pay_check(self):
+        time.sleep(0.002)
+
+    def pay_to(self, user, money):
+        pass
+
+
+class SimulatedTouchPay(TouchPay):
+
+    def pay_check(self):
+        time.sleep(0.001)
+
+    def pay_to(self, user, money):
+        pass
+
+
+def benchmark(sizes=(1, 10, 100, 1000, 10000, 100000), max_single=1000):
+    for client_class, pay_type_class in ((AliPay, SimulatedFacePay), (WechatPay, SimulatedTouchPay)):
+        print(f"{client_class.__name__}({pay_type_class.__name__}())")
+        for size in sizes:
+            payments = [(f"商户{i}", 20) for i in range(size)]
+            # 屏蔽渠道提示信息的打印
+            with contextlib.redirect_stdout(io.StringIO()):
+                single = "-"
+                if size <= max_single:
+                    client = client_class(pay_type_class())
+                    start = time.perf_counter()
+                    for user, money in payments:
+                        client.pay(user, money)
+                    single = f"{size / (time.perf_counter() - start):.0f}"
+                client = client_class(pay_type_class())
+                start = time.perf_counter()
+                client.pay_many(payments)
+                batch = size / (time.perf_counter() - start)
+            print(f"{size:>8} 笔: 逐笔 {single:>8} 笔/s, 批量 {batch:>10.0f} 笔/s")
+
+
+# ---------------------------------------------------------------------------------------------
+# 异步支付流水线: 桥接类都是同步的，一个慢速的校验就会阻塞整个收银 worker
+# AsyncPayPipeline 复用同一套 IPayClient / IPayType 桥接结构，把同步的支付调用放到线程池中执行，并且:
+#   1、限制每个支付渠道同时在途的支付数量
+#   2、按幂等键(idempotency key)去重，重复提交直接返回第一次的结果，不会重复扣款
+#   3、每笔支付都追加写入本地账本文件，多笔支付合并为一次 fsync(group commit)，写入磁盘后才返回结果
+
+PipelineResult = namedtuple("PipelineResult", ["idempotency_key", "channel", "user", "money", "ok", "error", "duplicate"])
+
+
+class PaymentLedger:
+    """只追加的账本文件，每行一条 JSON 记录"""
+
+    def __init__(self, path: str, executor=None) -> None:
+        self.path = path
+        self._executor = executor
+        self._queue = None
+        self._writer = None
+        self._file = None
+        self.commits = 0
+
+    def load(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as f:
+            data = f.read()
+        records = []
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if end < 0:
+                break
+            try:
+                records.append(json.loads(data[start:end]))
+            except ValueError:
+                break
+            start = end + 1
+        # 崩溃时最后一行可能只写了一半，截断到最后一条完整记录，否则之后追加的记录会接在半行后面
+        if start != len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(start)
+        return records
+
+    async def start(self) -> None:
+        self._file = open(self.path, "ab")
+        self._queue = asyncio.Queue()
+        self._writer = asyncio.ensure_future(self._write_loop())
+
+    def _write(self, data: bytes) -> None:
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def _write_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            batch = [await self._queue.get()]
+            # fsync 期间到达的记录都会在这里被一次取出，合并为一次提交
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if batch[-1] is None:
+                closing = True
+                batch.pop()
+            if not batch:
+                continue
+            data = b"".join(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n" for record, _ in batch)
+            try:
+                await loop.run_in_executor(self._executor, self._write, data)
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            self.commits += 1
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    async def append(self, record: dict) -> None:
+        """记录写入磁盘并 fsync 之后才返回"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((record, future))
+        await future
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._queue.put_nowait(None)
+            await self._writer
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class AsyncPayPipeline:
+
+    def __init__(self, ledger_path: str, max_in_flight: int = 64, max_workers: int = None) -> None:
+        self.max_in_flight = max_in_flight
+        self._executor = ThreadPoolExecutor(max_workers or max_in_flight * 2)
+        self.ledger = PaymentLedger(ledger_path, self._executor)
+        self._channels = {}
+        self._results = {}
+        self._pending = set()
+
+    async def __aenter__(self) -> 'AsyncPayPipeline':
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        # 重启后依然认得已经处理过的幂等键
+        for record in self.ledger.load():
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(PipelineResult(duplicate=False, **record))
+            self._results[record["idempotency_key"]] = future
+        await self.ledger.start()
+
+    async def close(self) -> None:
+        # 调用方被取消但已经开始扣款的支付还在后台写账本，等它们完成
+        if self._pending:
+            await asyncio.wait(self._pending)
+        await self.ledger.close()
+        self._executor.shutdown()
+
+    def _semaphore(self, channel: str) -> asyncio.Semaphore:
+        try:
+            return self._channels[channel]
+        except KeyError:
+            semaphore = self._channels[channel] = asyncio.Semaphore(self.max_in_flight)
+            return semaphore
+
+    async def pay(self, client: IPayClient, user: str, money: float, idempotency_key: str) -> PipelineResult:
+        """
+        调用方被取消时:
+            还在等待渠道名额、没有开始扣款 -> 放弃这笔支付，幂等键可以重试
+            已经开始扣款 -> 支付在后台继续完成并写入账本，幂等键保持占用，重复提交拿到的是这次的结果
+        NOTE: 扣款完成到账本 fsync 之间进程崩溃，重启后账本里没有这笔记录，同一个幂等键会再次扣款;
+        需要跨崩溃的保护时，应该在扣款前先写一条意向记录，或者由支付渠道侧按幂等键去重
+        """
+        while True:
+            existing = self._results.get(idempotency_key)
+            if existing is None:
+                break
+            try:
+                result = await asyncio.shield(existing)
+            except asyncio.CancelledError:
+                # 第一次提交在开始扣款前被取消，这笔支付根本没有发生: 重复提交者自己成为新的第一次提交
+                if existing.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+            return result._replace(duplicate=True)
+        loop = asyncio.get_running_loop()
+        future = self._results[idempotency_key] = loop.create_future()
+        started = asyncio.Event()
+        task = loop.create_task(self._pay(client, user, money, idempotency_key, started))
+        self._pending.add(task)
+        task.add_done_callback(functools.partial(self._settle, idempotency_key, future, started))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not started.is_set():
+                task.cancel()
+            raise
+
+    def _settle(self, idempotency_key, future, started, task) -> None:
+        self._pending.discard(task)
+        if not started.is_set():
+            # 没有开始扣款的支付允许使用同一个幂等键重试
+            del self._results[idempotency_key]
+        if task.cancelled():
+            future.cancel()
+        elif task.exception() is not None:
+            # 已经扣款但账本写入失败时幂等键保持占用，重复提交会得到同样的异常而不是再扣一次
+            future.set_exception(task.exception())
+            # 标记异常已被读取，没有重复提交在等待时也不会产生警告
+            future.exception()
+        else:
+            future.set_result(task.result())
+
+    async def _pay(self, client, user, money, idempotency_key, started) -> PipelineResult:
+        channel = type(client).__name__
+        loop = asyncio.get_running_loop()
+        async with self._semaphore(channel):
+            started.set()
+            try:
+                await loop.run_in_executor(self._executor, client.pay, user, money)
+            except Exception as error:
+                ok, message = False, f"{type(error).__name__}: {error}"
+            else:
+                ok, message = True, None
+        record = {"idempotency_key": idempotency_key, "channel": channel, "user": user,
+                  "money": money, "ok": ok, "error": message}
+        await self.ledger.append(record)
+        return PipelineResult(duplicate=False, **record)
+
+
+def benchmark_pipeline(payments=10000, duplicate_ratio=0.05, max_in_flight=128):
+    async def run(ledger_path):
+        clients = [AliPay(SimulatedFacePay()), WechatPay(SimulatedTouchPay())]
+        latencies = []
+
+        async with AsyncPayPipeline(ledger_path, max_in_flight=max_in_flight) as pipeline:
+            async def one(i):
+                # 模拟客户端重复提交
+                key = f"order-{i if random.random() > duplicate_ratio else max(i - 1, 0)}"
+                start = time.perf_counter()
+                result = await pipeline.pay(clients[i % 2], f"商户{i}", 20, key)
+                latencies.append(time.perf_counter() - start)
+                return result
+
+            start = time.perf_counter()
+            results = await asyncio.gather(*(one(i) for i in range(payments)))
+            cost = time.perf_counter() - start
+            commits = pipeline.ledger.commits
+
+        latencies.sort()
+        duplicates = sum(result.duplicate for result in results)
+        return (f"{payments} 笔并发支付: {cost:.2f}s, p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.0f}ms, 重复提交 {duplicates}, fsync {commits} 次")
+
+    # 屏蔽渠道提示信息的打印
+    with tempfile.TemporaryDirectory() as workdir, contextlib.redirect_stdout(io.StringIO()):
+        summary = asyncio.run(run(os.path.join(workdir, "ledger.jsonl")))
+    print(summary)
+
+
+# ---------------------------------------------------------------------------------------------
+# 结算聚合: 每一笔支付只是一次 print，没有任何汇总，日终需要对上百万笔支付按商户、渠道结算
+# SettlementAggregator 以流的方式消费支付事件，只保存 商户 x 渠道 的累计值:
+#   金额统一用整数"分"保存，避免浮点误差; 每个渠道两个 array('q')，下标是商户编号，比字典 + int 对象紧凑得多
+
+class SettlementAggregator:
+    """作为 listener 挂在 AsyncPayPipeline 上时会在线程池中被并发调用，写入和汇总都在锁内进行"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._merchants = {}
+        self._merchant_names = []
+        self._channels = {}
+        self._totals = []       # 渠道编号 -> array('q')，按商户编号保存累计金额(分)
+        self._counts = []
+        self.events = 0
+
+    def _merchant_index(self, merchant: str) -> int:
+        index = self._merchants.get(merchant)
+        if index is None:
+            index = self._merchants[merchant] = len(self._merchant_names)
+            self._merchant_names.append(merchant)
+            for totals, counts in zip(self._totals, self._counts):
+                totals.append(0)
+                counts.append(0)
+        return index
+
+    def _channel_index(self, channel: str) -> int:
+        index = self._channels.get(channel)
+        if index is None:
+            index = self._channels[channel] = len(self._totals)
+            self._totals.append(array("q", bytes(8 * len(self._merchant_names))))
+            self._counts.append(array("q", bytes(8 * len(self._merchant_names))))
+        return index
+
+    def __call__(self, event: PaymentEvent) -> None:
+        """可以直接作为 IPayClient 的 listener"""
+        self.add(*event)
+
+    def add(self, merchant: str, channel: str, cents: int) -> None:
+        with self._lock:
+            channel_index = self._channels.get(channel)
+            if channel_index is None:
+                channel_index = self._channel_index(channel)
+            merchant_index = self._merchants.get(merchant)
+            if merchant_index is None:
+                merchant_index = self._merchant_index(merchant)
+            self._totals[channel_index][merchant_index] += cents
+            self._counts[channel_index][merchant_index] += 1
+            self.events += 1
+
+    def consume(self, events, report_every: int = 0):
+        """
+        消费事件流，每处理 report_every 个事件产出一次阶段性汇总，事件本身不会被保存
+        """
+        add = self.add
+        i = 0
+        for i, (merchant, channel, cents) in enumerate(events, 1):
+            add(merchant, channel, cents)
+            if report_every and i % report_every == 0:
+                yield self.summary()
+        if not report_every or i == 0 or i % report_every:
+            yield self.summary()
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "events": self.events,
+                "merchants": len(self._merchant_names),
+                "total_cents": sum(sum(totals) for totals in self._totals),
+                "channels": {channel: sum(self._totals[index]) for channel, index in self._channels.items()},
+            }
+
+    def report(self):
+        """逐行产出 (商户, 渠道, 金额(分), 笔数)，不在内存中拼装完整的报表"""
+        with self._lock:
+            channels = list(self._channels.items())
+        for channel, channel_index in channels:
+            # 每个渠道复制一次数组，避免遍历期间持有锁，同时拿到一致的快照
+            with self._lock:
+                names = self._merchant_names[:]
+                totals, counts = self._totals[channel_index][:], self._counts[channel_index][:]
+            for merchant_index, merchant in enumerate(names):
+                if counts[merchant_index]:
+                    yield merchant, channel, totals[merchant_index], counts[merchant_index]
+
+
+def benchmark_settlement(events=10000000, merchants=100000):
+    channels = ("AliPay", "WechatPay", "UnionPay")
+    names = [f"商户{i}" for i in range(merchants)]
+
+    def stream():
+        rng = random.Random(7)
+        for _ in range(events):
+            yield names[rng.randrange(merchants)], channels[rng.randrange(3)], rng.randrange(100, 100000)
+
+    aggregator = SettlementAggregator()
+    start = time.perf_counter()
+    for summary in aggregator.consume(stream(), report_every=events // 5):
+        print(f"\t已处理 {summary['events']} 笔, 合计 {summary['total_cents'] / 100:.2f} 元")
+    cost = time.perf_counter() - start
+    accumulator_bytes = sum(totals.itemsize * len(totals) * 2 for totals in aggregator._totals)
+    rows = sum(1 for _ in aggregator.report())
+    print(f"{events} 笔: {cost:.2f}s ({events / cost:.0f} 笔/s), 累加器 {accumulator_bytes / 1024 / 1024:.1f} MiB, 报表 {rows} 行")
+
+
+if __name__ == "__main__":
+    benchmark()
+    benchmark_pipeline()
+
+    aggregator = SettlementAggregator()
+    client = AliPay(FacePay())
+    client.add_listener(aggregator)
+    client.pay_many([("王记小笼包", 20), ("王记小笼包", 12.5), ("李记面馆", 30)])
+    print(list(aggregator.report()))
+    benchmark_settlement()